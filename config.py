@@ -24,17 +24,89 @@ OPENID_FS_STORE_PATH = os.path.join(REPO_ROOT, 'openid-data')
 WSGI_BIND_ADDR = '127.0.0.1', 45474
 
 CORS_ALLOW_ORIGIN = '*'
+# Origins that may use the API, e.g. ['https://example.org',
+# 'https://*.example.org'], None allows all origins.
+CORS_ALLOWED_ORIGINS = None
 CORS_MAX_AGE = 3600
 CORS_ALLOW_HEADERS = 'Accept, Content-Type, Connection, Cookie'
 CORS_ALLOW_METHODS = 'GET, POST'
 CORS_ALLOW_CREDENTIALS = 'true'
+# Seconds browsers may cache the answer to a preflight request for
+CORS_PREFLIGHT_MAX_AGE = 86400
+
+# JSON library for the API responses: 'ujson', 'simplejson', 'json' or None to
+# use the fastest one that is installed.
+JSON_ENCODER = None
+
+# Responses of these types are compressed if they are at least
+# COMPRESS_MIN_SIZE bytes and the client accepts gzip, deflate or brotli.
+# Brotli requires the brotli module. Don't add text/html: the HTML pages carry
+# the CSRF token next to text from the query string, which compression would
+# expose to the BREACH attack.
+COMPRESS_MIMETYPES = ['application/json', 'application/javascript']
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+
+# Seconds clients may cache /talkatv.js for, when it's served as a bundle with
+# Raven, see SENTRY_PUBLIC_DSN. The bundle is also served under a fingerprinted
+# URL, /static/js/talkatv.<hash>.js, which may be cached forever.
+JS_BUNDLE_MAX_AGE = 3600
+
+# Paging of /api/comments, set these to None to return whole comment threads.
+COMMENTS_PAGE_SIZE = 50
+COMMENTS_MAX_PAGE_SIZE = 200
+COMMENTS_MAX_DEPTH = 5
+# Replies returned below each comment, the others are fetched by reply_to
+COMMENTS_REPLIES_PAGE_SIZE = 10
+# Whole threads with more comments than this are streamed to the client
+# instead of being built in memory, None to never stream.
+COMMENTS_STREAM_THRESHOLD = 500
+# Approximate size in bytes of the blocks a streamed response is sent in
+STREAM_BUFFER_SIZE = 8192
+
+# Query parameters that are removed from item URLs, so that links with e.g.
+# tracking parameters lead to the same comment thread. Shell-style wildcards
+# are allowed. Site owners can add their own parameters per site.
+ITEM_URL_IGNORED_PARAMS = ['utm_*', 'fbclid', 'gclid']
+
+# /api/counts, maximum number of URLs per request and seconds clients may
+# cache the counts.
+COUNTS_MAX_URLS = 100
+COUNTS_MAX_AGE = 60
+
+# Cache for the comment thread data served by /api/comments, shared between
+# all visitors. Either 'memory' (per process), 'filesystem' (shared between
+# processes) or None to disable it.
+RESPONSE_CACHE = 'memory'
+RESPONSE_CACHE_DIR = os.path.join(REPO_ROOT, 'cache')
+RESPONSE_CACHE_THRESHOLD = 500
+RESPONSE_CACHE_TIMEOUT = 300
 
 # EMAIL
 NOTIFICATION_ADDR = 'notifications@talka.tv'
 
+# Notifications are queued in the database and sent by notify.py. Failed
+# sends are retried up to NOTIFICATION_MAX_ATTEMPTS times, waiting
+# NOTIFICATION_RETRY_DELAY seconds before the first retry and twice as long
+# before each following one.
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 60
+NOTIFICATION_POLL_INTERVAL = 10
+NOTIFICATION_BATCH_SIZE = 50
+# Number of threads sending notifications in notify.py
+NOTIFICATION_WORKERS = 1
+# Notifications to the same user are collected for this many seconds and sent
+# as one digest. Users can change this in their profile, 0 sends each
+# notification right away.
+NOTIFICATION_DIGEST_WINDOW = 600
+
 # SMTP
 SMTP_SSL = False
 SMTP_HOST = 'localhost'
 SMTP_PORT = None  # None == use default port
 SMTP_USER = ''
 SMTP_PASS = ''
+# Connections are pooled, SMTP_POOL_SIZE limits the number of open
+# connections and idle connections are closed after SMTP_IDLE_TIMEOUT seconds.
+SMTP_POOL_SIZE = 4
+SMTP_IDLE_TIMEOUT = 60
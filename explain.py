@@ -0,0 +1,180 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import re
+import sys
+
+from datetime import datetime
+
+from sqlalchemy import func
+
+from talkatv import app, db
+from talkatv.api import get_thread_query, get_replies_query
+from talkatv.models import Comment, Item, Site, OpenID, Notification
+from talkatv.tools.query import match_prefix
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+SQLITE_SCAN = re.compile(
+        r'^SCAN (?:TABLE )?"?(?P<table>[^\s"]+)"?(?P<rest>.*)$')
+POSTGRES_SCAN = re.compile(r'Seq Scan on "?(?P<table>[^\s"]+)')
+
+
+def get_hot_queries():
+    '''
+    Returns ``(name, query)`` pairs of the queries that are run when the
+    comment widget is loaded, when users log in and when notifications are
+    sent, with example arguments.
+    '''
+    item = Item(u'http://example.org/', None)
+    item.id = 1
+
+    comments = []
+
+    for comment_id in (1, 2):
+        comment = Comment(item, None, u'')
+        comment.id = comment_id
+        comment.path = Comment.make_path(comment_id)
+        comment.depth = 0
+        comments.append(comment)
+
+    return [
+            ('thread page', get_thread_query(item)\
+                    .filter(Comment.reply_to_id == None)\
+                    .limit(app.config['COMMENTS_PAGE_SIZE'] or 50)),
+            ('thread replies', get_replies_query(comments, 2, 10)),
+            ('whole thread', get_thread_query(item)),
+            ('reply counts', db.session.query(
+                    Comment.reply_to_id,
+                    func.count(Comment.id))\
+                    .filter(Comment.reply_to_id.in_([1, 2]))\
+                    .group_by(Comment.reply_to_id)),
+            ('item by URL', Item.query.filter(Item.url_hash == '0' * 40)),
+            ('comment counts', db.session.query(
+                    Item.url_hash,
+                    Item.comment_count)\
+                    .filter(Item.url_hash.in_(['0' * 40, '1' * 40]))),
+            ('site by host', Site.query\
+                    .filter(Site.domain.in_([u'www.example.org',
+                        u'example.org']))\
+                    .order_by(func.length(Site.domain).desc())\
+                    .limit(1)),
+            ('sites of user', Site.query.filter(Site.owner_id == 1)),
+            ('items of site', Item.query.filter(match_prefix(
+                    Item.reversed_host,
+                    Item.reverse_host(u'example.org')))),
+            ('OpenID login', OpenID.query.filter(
+                    OpenID.url == u'http://example.org/openid')),
+            ('item list', Item.query.order_by(Item.created.desc()).limit(20)),
+            ('due notifications', Notification.query\
+                    .filter(Notification.sent == None)\
+                    .filter(Notification.attempts < 5)\
+                    .filter(Notification.send_after <= datetime.utcnow())\
+                    .with_entities(Notification.recipient)\
+                    .group_by(Notification.recipient)\
+                    .order_by(func.min(Notification.send_after))\
+                    .limit(50))]
+
+
+def explain(query):
+    '''
+    Returns the lines of the query plan of ``query``.
+
+    Supports SQLite, using ``EXPLAIN QUERY PLAN``, and PostgreSQL, using
+    ``EXPLAIN``.
+    '''
+    compiled = query.with_labels().statement.compile(
+            dialect=db.engine.dialect)
+    params = compiled.params
+
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+
+    if db.engine.name == 'sqlite':
+        sql = u'EXPLAIN QUERY PLAN ' + unicode(compiled)
+    else:
+        sql = u'EXPLAIN ' + unicode(compiled)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(sql, params)
+
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def find_table_scans(plan):
+    '''
+    Returns the names of the tables that are read in full in ``plan``,
+    ignoring scans of subqueries and of indexes.
+    '''
+    tables = set(table.name for table in db.metadata.sorted_tables)
+    scans = []
+
+    for line in plan:
+        if db.engine.name == 'sqlite':
+            match = SQLITE_SCAN.match(line)
+
+            if match and not 'USING' in match.group('rest'):
+                scans.append(match.group('table'))
+        else:
+            match = POSTGRES_SCAN.search(line)
+
+            if match:
+                scans.append(match.group('table'))
+
+    return [table for table in scans if table in tables]
+
+
+def check_query_plans():
+    '''
+    Explain each of the hot queries, see :py:func:`get_hot_queries`, and
+    log those that fall back to scanning a table.
+
+    On PostgreSQL sequential scans are disabled for the session, so that the
+    planner uses an index wherever there is one, regardless of the size of
+    the tables.
+
+    :rtype: True if none of the queries scans a table
+    '''
+    if db.engine.name == 'postgresql':
+        db.session.execute('SET enable_seqscan = off')
+
+    ok = True
+
+    for name, query in get_hot_queries():
+        plan = explain(query)
+        scans = find_table_scans(plan)
+
+        if scans:
+            ok = False
+            _log.error('{0}: scans {1}\n    {2}'.format(
+                name,
+                ', '.join(scans),
+                '\n    '.join(plan)))
+        else:
+            _log.info('{0}: OK\n    {1}'.format(name, '\n    '.join(plan)))
+
+    db.session.rollback()
+
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_query_plans() else 1)
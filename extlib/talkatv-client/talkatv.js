@@ -195,9 +195,69 @@ var talkatvClient = new Object();
 
             dq.commentContainer.innerHTML = '';
             dq.renderComments(response.comments);
-        }), {
+
+            if (response.next_cursor)
+                dq.renderMoreLink(dq.commentContainer, 'Show more comments', {
+                    cursor: response.next_cursor});
+        }), dq.getCommentParams());
+    };
+
+    /**
+     * getCommentParams - Get the GET parameters for /api/comments
+     *
+     * Arguments:
+     *  - extra: additional parameters, e.g. `cursor` and `reply_to`
+     */
+    dq.getCommentParams = function (extra) {
+        var params = {
             item_url: dq.getCurrentURL(),
-            item_title: document.title});
+            item_title: document.title};
+
+        for (param in extra)
+            params[param] = extra[param];
+
+        return params;
+    };
+
+    /**
+     * renderMoreLink - Render a link that fetches the next page of comments
+     *
+     * Arguments:
+     *  - parentEm: the element the comments should be rendered into
+     *  - text: link text
+     *  - params: the `cursor` of the next page and/or `reply_to`, the id
+     *    of the comment whose replies should be fetched
+     */
+    dq.renderMoreLink = function (parentEm, text, params) {
+        var moreLink = dq.makeElement('a', {
+            text: text,
+            class: 'talkatv-more-link',
+            href: '#'});
+
+        moreLink.onclick = function (e) {
+            e.preventDefault();
+            parentEm.removeChild(moreLink);
+
+            dq.request('/comments', dq.requestCallbackHelper(function (response, error) {
+                if (error)
+                    return;
+
+                dq.renderComments(response.comments, parentEm);
+
+                if (! response.next_cursor)
+                    return;
+
+                if (params.reply_to)
+                    dq.renderMoreLink(parentEm, 'Show more replies', {
+                        cursor: response.next_cursor,
+                        reply_to: params.reply_to});
+                else
+                    dq.renderMoreLink(parentEm, 'Show more comments', {
+                        cursor: response.next_cursor});
+            }), dq.getCommentParams(params));
+        };
+
+        parentEm.appendChild(moreLink);
     };
 
     /**
@@ -365,6 +425,20 @@ var talkatvClient = new Object();
             if (comment.replies) {
                 dq.renderComments(comment.replies, container);
             }
+
+            if (comment.more_replies) {
+                var moreParams = {reply_to: comment.id};
+
+                // Only some of the replies were included, continue after them
+                if (comment.replies_cursor)
+                    moreParams.cursor = comment.replies_cursor;
+
+                dq.renderMoreLink(container,
+                    'Show ' + comment.more_replies + (
+                        comment.replies_cursor ? ' more' : '') + (
+                        comment.more_replies == 1 ? ' reply' : ' replies'),
+                    moreParams);
+            }
         }
         dq.reversedListsPolyfill();
     };
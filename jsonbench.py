@@ -0,0 +1,127 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import random
+import timeit
+
+from talkatv import app, db
+from talkatv.api import get_shared_context
+from talkatv.models import User
+from talkatv.tools.encoding import ENCODERS, get_encoder
+
+from querybench import seed_thread
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+#: Number of comments in the seeded threads
+THREAD_SIZES = [100, 2000]
+#: Number of times each encoding is timed, the best time is reported
+REPEAT = 20
+
+
+def get_payloads(item):
+    '''
+    Returns ``(name, context)`` pairs of the shared contexts of the API
+    responses for ``item``, see :py:func:`talkatv.api.get_shared_context`.
+    '''
+    return [
+            ('whole thread', get_shared_context(item)),
+            ('first page', get_shared_context(item,
+                limit=app.config['COMMENTS_PAGE_SIZE'],
+                max_depth=app.config['COMMENTS_MAX_DEPTH'],
+                replies_limit=app.config['COMMENTS_REPLIES_PAGE_SIZE']))]
+
+
+def get_encoders():
+    '''
+    Returns ``(name, encoder)`` pairs of the installed :py:data:`ENCODERS`.
+    '''
+    encoders = []
+
+    for name in ENCODERS:
+        try:
+            encoders.append((name, get_encoder(name)))
+        except ValueError:
+            _log.info('{0} is not available'.format(name))
+
+    return encoders
+
+
+def time_encoders(encoders, payload):
+    '''
+    Time each of the ``encoders`` on ``payload``, compact and indented like
+    the responses to non-XHR requests.
+
+    Returns ``(name, compact ms, indented ms)`` tuples. Raises an
+    ``AssertionError`` if an encoder returns different data than the
+    stdlib encoder.
+    '''
+    expected = json.loads(get_encoder('json')(payload))
+    timings = []
+
+    for name, encode in encoders:
+        assert json.loads(encode(payload)) == expected, name
+
+        compact = min(timeit.repeat(lambda: encode(payload),
+            number=1, repeat=REPEAT))
+        indented = min(timeit.repeat(lambda: encode(payload, indent=2),
+            number=1, repeat=REPEAT))
+
+        timings.append((name, compact * 1000, indented * 1000))
+
+    return timings
+
+
+def run_benchmarks():
+    '''
+    Seed threads of increasing size and time the encoders on their API
+    responses. The threads are added in a transaction that is rolled back.
+    '''
+    random.seed(1)
+    encoders = get_encoders()
+
+    try:
+        users = [User(u'jsonbench{0}'.format(i),
+                u'jsonbench{0}@example.org'.format(i))
+                for i in range(20)]
+        db.session.add_all(users)
+
+        for size in THREAD_SIZES:
+            item = seed_thread(size, users)
+
+            for payload_name, payload in get_payloads(item):
+                for name, compact, indented in time_encoders(encoders,
+                        payload):
+                    _log.info(
+                        '{0} comments, {1}, {2}: {3:.1f} ms compact, '
+                        '{4:.1f} ms indented'.format(
+                            size,
+                            payload_name,
+                            name,
+                            compact,
+                            indented))
+    finally:
+        db.session.rollback()
+
+
+if __name__ == '__main__':
+    run_benchmarks()
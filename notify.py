@@ -0,0 +1,75 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+import time
+
+from talkatv import app, db
+from talkatv.notification import process_outbox
+
+
+def run(worker=0, workers=1):
+    '''
+    Send queued notifications until interrupted. Waits
+    ``NOTIFICATION_POLL_INTERVAL`` seconds whenever the outbox is empty.
+    '''
+    app.logger.info('Notification worker {0} started'.format(worker))
+
+    while True:
+        try:
+            processed = process_outbox(worker=worker, workers=workers)
+        except Exception:
+            app.logger.exception('Failed to process the outbox')
+            db.session.rollback()
+            processed = 0
+        finally:
+            # Don't keep a transaction open while waiting
+            db.session.remove()
+
+        if not processed:
+            time.sleep(app.config['NOTIFICATION_POLL_INTERVAL'])
+
+
+def run_workers(workers):
+    '''
+    Run ``workers`` worker threads, each sending its share of the outbox over
+    its own connection from the SMTP pool.
+    '''
+    threads = [threading.Thread(target=run, args=(worker, workers))
+            for worker in range(workers)]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Join with a timeout, a blocking join can't be interrupted
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+
+
+if __name__ == '__main__':
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(app.debug_log_format))
+    app.logger.addHandler(handler)
+    app.logger.setLevel(logging.INFO)
+
+    if app.config['NOTIFICATION_WORKERS'] > 1:
+        run_workers(app.config['NOTIFICATION_WORKERS'])
+    else:
+        run()
@@ -0,0 +1,179 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import random
+import sys
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from talkatv import db
+from talkatv.api import get_comment_page, get_comment_tree
+from talkatv.item import get_url_hash
+from talkatv.models import Comment, Item, User
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+#: Number of comments in the seeded threads
+THREAD_SIZES = [10, 100, 1000, 5000]
+#: Number of users commenting on the seeded threads
+USERS = 20
+
+
+class QueryCounter(object):
+    '''
+    Counts the SQL statements sent to the database by ``engine``.
+    '''
+    def __init__(self, engine):
+        self.count = 0
+
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.count += 1
+
+    @contextmanager
+    def counting(self):
+        '''
+        Count the statements of the ``with`` block, the count is yielded as
+        a single item list that is filled in when the block exits.
+        '''
+        result = []
+        start = self.count
+
+        yield result
+
+        result.append(self.count - start)
+
+
+def seed_thread(size, users):
+    '''
+    Add an item with ``size`` comments to the session, each comment either
+    top-level or a reply to one of the earlier comments. Nothing is
+    committed.
+    '''
+    url = u'http://example.org/querybench/{0}'.format(size)
+    item = Item(url, u'Query benchmark', url_hash=get_url_hash(url))
+    db.session.add(item)
+
+    comments = []
+
+    for i in range(size):
+        reply_to = random.choice(comments) \
+                if comments and random.random() < 0.7 else None
+
+        comment = Comment(item, random.choice(users),
+                u'Comment {0}'.format(i), reply_to)
+        comment.render()
+        db.session.add(comment)
+        db.session.flush()
+        comment.set_path()
+
+        comments.append(comment)
+
+    item.comment_count = size
+    db.session.flush()
+
+    return item
+
+
+def get_benchmarks(item):
+    '''
+    Returns ``(name, function)`` pairs of the thread reads to count the
+    queries of. The reads return serialized comments, so queries issued by
+    lazy loading are counted as well.
+    '''
+    branch = item.comments.filter(Comment.reply_to_id == None)\
+            .order_by(Comment.id)\
+            .first()
+
+    return [
+            ('whole thread', lambda: get_comment_tree(item)),
+            ('first page', lambda: get_comment_page(item, 50, None, 3,
+                replies_limit=10)),
+            ('reply branch', lambda: get_comment_page(item, 50, None, 3,
+                branch.id, 10))]
+
+
+def run_benchmarks():
+    '''
+    Seed threads of increasing size and count the queries issued to read
+    them. Everything is done in one transaction that is rolled back, the
+    database is left as it was.
+
+    Returns True if none of the reads needs more queries on the larger
+    threads than on the smallest one.
+    '''
+    random.seed(1)
+    counter = QueryCounter(db.engine)
+    counts = {}
+
+    try:
+        users = [User(u'querybench{0}'.format(i),
+                u'querybench{0}@example.org'.format(i))
+                for i in range(USERS)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        user_ids = [user.id for user in users]
+
+        for size in THREAD_SIZES:
+            users = User.query.filter(User.id.in_(user_ids)).all()
+            item_id = seed_thread(size, users).id
+
+            # Start from an empty identity map, so that objects seeded in
+            # this session do not hide lazy loads
+            db.session.expunge_all()
+            item = Item.query.get(item_id)
+
+            for name, function in get_benchmarks(item):
+                start = time.time()
+
+                with counter.counting() as queries:
+                    function()
+
+                counts.setdefault(name, []).append(queries[0])
+
+                _log.info('{0} comments, {1}: {2} queries, {3:.1f} ms'.format(
+                    size,
+                    name,
+                    queries[0],
+                    (time.time() - start) * 1000))
+    finally:
+        db.session.rollback()
+
+    flat = True
+
+    for name, name_counts in counts.items():
+        if max(name_counts) > name_counts[0]:
+            _log.error('{0}: query count grows with the thread: {1}'.format(
+                name,
+                name_counts))
+            flat = False
+
+    return flat
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_benchmarks() else 1)
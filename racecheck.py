@@ -0,0 +1,101 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import sys
+import threading
+import time
+import urllib
+
+from talkatv import app, db
+from talkatv.item import canonicalize_url, get_url_hash
+from talkatv.models import Item
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+#: Number of readers loading the widget at once
+READERS = 32
+
+
+def first_load(url, start, results):
+    '''
+    Wait for ``start`` and load the comments of ``url`` once, like the
+    widget does. The status code, or the raised exception, is appended to
+    ``results``.
+    '''
+    client = app.test_client()
+    start.wait()
+
+    try:
+        response = client.get('/api/comments?' + urllib.urlencode({
+            'item_url': url,
+            'item_title': 'Race check'}))
+        results.append(response.status_code)
+    except Exception as exc:
+        results.append(exc)
+
+
+def check_first_loads(readers=READERS):
+    '''
+    Load the comments of a new page from ``readers`` threads at once, and
+    check that every load succeeds and that exactly one item is added. The
+    item is deleted again.
+
+    Returns True if the check passed.
+    '''
+    url = u'http://example.org/racecheck/{0}'.format(time.time())
+    url_hash = get_url_hash(canonicalize_url(url))
+
+    start = threading.Event()
+    results = []
+    threads = [threading.Thread(target=first_load, args=(url, start, results))
+            for i in range(readers)]
+
+    for thread in threads:
+        thread.start()
+
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    db.session.remove()
+
+    items = Item.query.filter(Item.url_hash == url_hash)
+    item_count = items.count()
+
+    errors = [result for result in results if result != 200]
+
+    _log.info('{0} loads, {1} errors, {2} items added'.format(
+        len(results),
+        len(errors),
+        item_count))
+
+    for error in errors:
+        _log.error('Failed load: {0}'.format(error))
+
+    items.delete()
+    db.session.commit()
+
+    return not errors and item_count == 1
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_first_loads() else 1)
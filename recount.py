@@ -0,0 +1,66 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+
+from sqlalchemy import select, func
+
+from talkatv import db
+from talkatv.api import RESPONSE_CACHE
+from talkatv.models import Item, Comment
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+
+def recount_items():
+    '''
+    Recompute the ``comment_count`` and ``last_comment_at`` columns of all
+    items from their comments, in a single transaction.
+
+    The version of every item is bumped as well, and the response cache is
+    cleared, so that cached threads are not served with stale counters. The
+    ``memory`` cache backend is local to each process, servers using it keep
+    serving their cached threads for up to ``RESPONSE_CACHE_TIMEOUT``
+    seconds.
+    '''
+    item_table = Item.__table__
+    comment_table = Comment.__table__
+
+    comments = select([func.count(comment_table.c.id)])\
+            .where(comment_table.c.item_id == item_table.c.id)
+    last_comment = select([func.max(comment_table.c.created)])\
+            .where(comment_table.c.item_id == item_table.c.id)
+
+    result = db.session.execute(item_table.update().values(
+        comment_count=comments.as_scalar(),
+        last_comment_at=last_comment.as_scalar(),
+        version=func.coalesce(item_table.c.version, 0) + 1))
+
+    db.session.commit()
+
+    RESPONSE_CACHE.clear()
+
+    _log.info('Recounted {0} items'.format(result.rowcount))
+
+    return result.rowcount
+
+
+if __name__ == '__main__':
+    recount_items()
@@ -0,0 +1,66 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from sqlalchemy import or_
+
+from talkatv import db
+from talkatv.models import Comment
+from talkatv.comment import parse_comments, RENDERER_VERSION
+
+logging.basicConfig()
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.INFO)
+
+BATCH_SIZE = 500
+
+
+def rerender_comments(batch_size=BATCH_SIZE):
+    '''
+    Render and store the HTML of all comments that have not been rendered by
+    the current renderer version. Commits once per batch.
+    '''
+    stale = Comment.query.filter(or_(
+        Comment.html_version == None,
+        Comment.html_version != RENDERER_VERSION))\
+                .order_by(Comment.id)
+
+    total = 0
+
+    while True:
+        comments = stale.limit(batch_size).all()
+
+        if not comments:
+            break
+
+        rendered = parse_comments([comment.text for comment in comments])
+
+        for comment, html in zip(comments, rendered):
+            comment.html = html
+            comment.html_version = RENDERER_VERSION
+
+        db.session.commit()
+
+        total += len(comments)
+        _log.info('Rendered {0} comments'.format(total))
+
+    return total
+
+
+if __name__ == '__main__':
+    rerender_comments()
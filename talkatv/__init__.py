@@ -51,3 +51,9 @@ import talkatv.api.views
 import talkatv.comment.views
 import talkatv.site.views
 import talkatv.salmon.views
+
+from talkatv.tools.compress import ResponseCompressor
+from talkatv.tools.cors import PreflightMiddleware
+
+ResponseCompressor(app)
+app.wsgi_app = PreflightMiddleware(app.wsgi_app, app.config)
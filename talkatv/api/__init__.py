@@ -14,15 +14,33 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import hashlib
+
+from collections import defaultdict
+from datetime import datetime
+
 from flask import g, abort
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload
 
 from talkatv import app, db
-from talkatv.models import Comment
-from talkatv.notification import send_comment_notification
+from talkatv._version import __version__
+from talkatv.comment import RENDERER_VERSION
+from talkatv.models import Comment, Item
+from talkatv.tools.cache import make_cache
+from talkatv.tools.cors import ENCODER
+from talkatv.tools.query import match_prefix
+from talkatv.notification import queue_comment_notification
+
+#: Cache of the thread data served by the API, see :py:func:`get_thread`
+RESPONSE_CACHE = make_cache(app.config, 'RESPONSE_CACHE')
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 
 def post_comment(item, comment_data, user):
-    comment_args = [item, g.user, comment_data['comment']]
+    comment_args = [item, user, comment_data['comment']]
 
     if 'reply_to' in comment_data:
         reply_to = Comment.query.filter(Comment.item == item)\
@@ -31,7 +49,7 @@ def post_comment(item, comment_data, user):
 
         if not reply_to:
             app.logger.error('Invalid reply_to field: {0}'.format({
-                'user': g.user.id,
+                'user': user.id,
                 'comment_data': comment_data,
                 'item': item.as_dict()}))
 
@@ -40,32 +58,42 @@ def post_comment(item, comment_data, user):
             comment_args.append(reply_to)
 
     comment = Comment(*comment_args)
+    comment.render()
     db.session.add(comment)
-    db.session.commit()
+    # The path contains the id of the comment itself
+    db.session.flush()
+    comment.set_path()
+
+    item.version = Item.version + 1
+    item.comment_count = Item.comment_count + 1
+    item.last_comment_at = comment.created
 
-    emails = []
+    recipients = {}
 
     if comment.reply_to:
-        emails.append(comment.reply_to.user.email)
+        recipients[comment.reply_to.user_id] = comment.reply_to.user
 
     if item.site:
-        emails.append(item.site.owner.email)
+        recipients[item.site.owner_id] = item.site.owner
 
-    emails = set(emails)
-
-    if emails:
-        app.logger.debug('Sending notification about {0} to {1}'.format(
+    if recipients:
+        app.logger.debug('Queueing notification about {0} to {1}'.format(
             comment.text,
-            ', '.join(emails)))
+            ', '.join(recipient.email for recipient in recipients.values())))
 
-    for email in emails:
-        # Send comment notification to users that posted on the page
-        send_comment_notification(
-                email,
-                g.user,
+    for recipient in recipients.values():
+        # Notify the users that posted on the page, the notifications are
+        # committed along with the comment
+        queue_comment_notification(
+                recipient,
+                user,
                 comment,
                 item)
 
+    db.session.commit()
+
+    RESPONSE_CACHE.delete(get_thread_cache_key(item.id))
+
     return comment
 
 
@@ -73,22 +101,31 @@ def get_context(item):
     '''
     Returns item and comment data in a JSON serializable format.
     '''
-    comments = item.comments.filter(Comment.reply_to == None)\
-            .order_by(Comment.created.desc())
+    return add_user_context(get_shared_context(item))
 
-    comments_data = []
 
-    for comment in comments.all():
-        comment_dict = comment.as_dict()
-        comments_data.append(comment_dict)
-
-        if comment.replies.count():
-            traverse_comments(comment_dict, comment.replies.all())
+def get_shared_context(item, **page_args):
+    '''
+    Returns the part of :py:func:`get_context` that is the same for all users
+    and thus may be cached. Pass paging arguments, see
+    :py:func:`get_page_args`, to get a page of the comments instead of the
+    whole thread.
+    '''
+    comments_data, next_cursor = get_comment_page(item, **page_args)
 
-    context_data = {
+    return {
             'item': item.as_dict(),
             'comments': comments_data,
-            'comment_count': comments.count()}
+            'comment_count': item.comment_count,
+            'next_cursor': next_cursor}
+
+
+def add_user_context(context_data):
+    '''
+    Returns a copy of ``context_data`` with the data that is specific to the
+    active user added.
+    '''
+    context_data = dict(context_data)
 
     if g.user:
         context_data.update({'logged_in_as': g.user.username})
@@ -96,20 +133,466 @@ def get_context(item):
     return context_data
 
 
-def traverse_comments(parent_dict, replies):
+def get_thread(item_url):
+    '''
+    Returns the cached thread for ``item_url``, or None.
+
+    A thread is a dict holding the ``item_id``, ``version`` and ``modified``
+    values of the item. It is used to validate conditional requests and to
+    look up the cached context, see :py:func:`get_cached_context`, without
+    querying the database.
+
+    The cache maps each requested URL to the id of its item, so that the
+    variants of an item URL share the thread, see
+    :py:func:`talkatv.item.canonicalize_url`.
+    '''
+    item_id = RESPONSE_CACHE.get(get_url_cache_key(item_url))
+
+    if item_id is None:
+        return None
+
+    return RESPONSE_CACHE.get(get_thread_cache_key(item_id))
+
+
+def cache_thread(item_url, item):
+    '''
+    Store the thread of ``item`` in the response cache and return it.
+
+    A comment may be posted, and the thread invalidated, after ``item`` was
+    loaded and before the thread is stored. The version of the item is read
+    again once the thread is stored, and the stale thread is removed if it
+    has changed.
+    '''
+    thread = {
+            'item_id': item.id,
+            'version': item.version,
+            'modified': item.modified,
+            'comment_count': item.comment_count}
+
+    RESPONSE_CACHE.set(get_url_cache_key(item_url), item.id)
+    RESPONSE_CACHE.set(get_thread_cache_key(item.id), thread)
+
+    version = db.session.query(Item.version)\
+            .filter(Item.id == item.id)\
+            .scalar()
+
+    if version != item.version:
+        RESPONSE_CACHE.delete(get_thread_cache_key(item.id))
+
+    return thread
+
+
+def forget_threads(item_ids):
+    '''
+    Remove the cached threads of the items with ``item_ids``, after their
+    versions have been changed by a bulk update. Call this once the update
+    is committed, else a concurrent request may cache the old version again.
+    '''
+    RESPONSE_CACHE.delete_many(*[get_thread_cache_key(item_id)
+        for item_id in item_ids])
+
+
+def get_cached_context(thread, page_args, item=None):
+    '''
+    Returns the shared context, see :py:func:`get_shared_context`, for a page
+    of the thread from the response cache, or builds and caches it.
+
+    Cached contexts are keyed by the item version, posting a comment makes
+    the cached contexts of the item unreachable.
+    '''
+    key = 'context:{0}:{1}:{2}'.format(
+            thread['item_id'],
+            thread['version'],
+            hashlib.sha1(repr(sorted(page_args.items()))).hexdigest())
+
+    context_data = RESPONSE_CACHE.get(key)
+
+    if context_data is None:
+        if item is None:
+            item = Item.query.get(thread['item_id'])
+
+        context_data = get_shared_context(item, **page_args)
+        RESPONSE_CACHE.set(key, context_data)
+
+    return context_data
+
+
+def get_url_cache_key(item_url):
+    return 'url:' + hashlib.sha1(item_url.encode('utf-8')).hexdigest()
+
+
+def should_stream(thread, page_args):
+    '''
+    Returns True if the response for a page of the thread should be streamed
+    with :py:func:`iter_thread_json`, instead of being built in memory and
+    cached. That is the case when the whole thread is requested and it has
+    more than ``COMMENTS_STREAM_THRESHOLD`` comments.
+    '''
+    if app.config['COMMENTS_STREAM_THRESHOLD'] is None:
+        return False
+
+    if any(arg is not None for arg in page_args.values()):
+        return False
+
+    return thread.get('comment_count', 0) > \
+            app.config['COMMENTS_STREAM_THRESHOLD']
+
+
+def iter_thread_json(item, context_data):
+    '''
+    Yields the JSON of :py:func:`get_context` for the whole thread of
+    ``item``, in parts.
+
+    The comments are fetched with one query, like in
+    :py:func:`get_comment_tree`, but instead of building the nested dicts of
+    the thread and serializing them at once, each comment is serialized as
+    the reply hierarchy is walked.
+
+    :param dict context_data: the rest of the context, e.g. from
+        :py:func:`add_user_context`
+    '''
+    replies_index = defaultdict(list)
+
+    for comment in get_thread_query(item):
+        replies_index[comment.reply_to_id].append(comment)
+
+    context_data = dict(context_data,
+            item=item.as_dict(),
+            comment_count=item.comment_count,
+            next_cursor=None)
+
+    # Leave the object open for the comments
+    yield ENCODER(context_data)[:-1] + ', "comments": ['
+
+    # Stack of iterators over the comments on each level of the walk
+    levels = [iter(replies_index.pop(None, []))]
+    separator = ''
+
+    while levels:
+        comment = next(levels[-1], None)
+
+        if comment is None:
+            levels.pop()
+            # Close the replies and the comment they are replies to, or the
+            # top-level comments and the context
+            yield ']}'
+            separator = ', '
+            continue
+
+        comment_json = ENCODER(comment.as_dict())
+        replies = replies_index.pop(comment.id, None)
+
+        if replies:
+            yield separator + comment_json[:-1] + ', "replies": ['
+            levels.append(iter(replies))
+            separator = ''
+        else:
+            yield separator + comment_json
+            separator = ', '
+
+
+def get_thread_cache_key(item_id):
+    return 'thread:{0}'.format(item_id)
+
+
+def get_etag(thread, query_string=''):
+    '''
+    Returns the ETag for the API response of a thread. It's sent as a weak
+    ETag if the response is compressed, see
+    :py:class:`talkatv.tools.compress.ResponseCompressor`.
+
+    The ETag changes when a comment is posted on the item, and it differs
+    between users, since the response carries the ``logged_in_as`` field,
+    and between query strings, which hold the paging arguments and the JSONP
+    callback.
+    '''
+    etag = hashlib.sha1(u'{0}:{1}:{2}:{3}:{4}:'.format(
+        __version__,
+        RENDERER_VERSION,
+        thread['item_id'],
+        thread['version'],
+        g.user.username if g.user else u'').encode('utf-8'))
+
+    etag.update(query_string)
+
+    return etag.hexdigest()
+
+
+def get_page_args(args):
     '''
-    Iterate down a hirearchy of comment replies, the populate the parent_dict
-    with the data found.
+    Returns the paging arguments of an API request, as keyword arguments for
+    :py:func:`get_comment_page`.
+
+    - ``limit``: Number of comments to return. Defaults to
+      ``COMMENTS_PAGE_SIZE`` and can't be more than ``COMMENTS_MAX_PAGE_SIZE``.
+    - ``cursor``: The ``next_cursor`` of the previous page.
+    - ``max_depth``: Levels of replies to return below each comment. Defaults
+      to, and can't be more than, ``COMMENTS_MAX_DEPTH``.
+    - ``reply_to``: Return the replies to this comment instead of the
+      top-level comments.
+    - ``replies_limit``: Number of replies to return below each comment.
+      Defaults to ``COMMENTS_REPLIES_PAGE_SIZE`` and can't be more than
+      ``COMMENTS_MAX_PAGE_SIZE``.
+
+    Aborts with ``400 Bad Request`` on invalid arguments.
+    '''
+    limit = get_int_arg(args, 'limit', app.config['COMMENTS_PAGE_SIZE'])
+    max_depth = get_int_arg(args, 'max_depth',
+            app.config['COMMENTS_MAX_DEPTH'])
+    replies_limit = get_int_arg(args, 'replies_limit',
+            app.config['COMMENTS_REPLIES_PAGE_SIZE'])
+
+    if limit is not None:
+        if limit < 1:
+            abort(400)
+
+        if app.config['COMMENTS_MAX_PAGE_SIZE'] is not None:
+            limit = min(limit, app.config['COMMENTS_MAX_PAGE_SIZE'])
+
+    if replies_limit is not None:
+        if replies_limit < 1:
+            abort(400)
+
+        if app.config['COMMENTS_MAX_PAGE_SIZE'] is not None:
+            replies_limit = min(replies_limit,
+                    app.config['COMMENTS_MAX_PAGE_SIZE'])
+
+    if max_depth is not None and app.config['COMMENTS_MAX_DEPTH'] is not None:
+        max_depth = min(max_depth, app.config['COMMENTS_MAX_DEPTH'])
+
+    cursor = args.get('cursor')
+
+    return {
+            'limit': limit,
+            'cursor': decode_cursor(cursor) if cursor else None,
+            'max_depth': max_depth,
+            'reply_to': get_int_arg(args, 'reply_to'),
+            'replies_limit': replies_limit}
+
+
+def get_int_arg(args, name, default=None):
+    value = args.get(name)
+
+    if not value:
+        return default
+
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+
+    if value < 0:
+        abort(400)
+
+    return value
+
+
+def encode_cursor(comment):
+    '''
+    Returns an opaque cursor pointing to the position after ``comment``.
+    '''
+    return base64.urlsafe_b64encode('{0}|{1}'.format(
+        comment.created.strftime(CURSOR_TIME_FORMAT),
+        comment.id))
+
+
+def decode_cursor(cursor):
+    '''
+    Returns the ``(created, id)`` tuple of a cursor created by
+    :py:func:`encode_cursor`. Aborts with ``400 Bad Request`` if the cursor
+    is invalid.
+    '''
+    try:
+        created, comment_id = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return datetime.strptime(created, CURSOR_TIME_FORMAT), int(comment_id)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def get_comment_page(item, limit=None, cursor=None, max_depth=None,
+        reply_to=None, replies_limit=None):
+    '''
+    Returns a page of the comments on an item and the cursor of the next
+    page, or None if this is the last page.
+
+    :param int limit: Maximum number of comments on the page, not counting
+        replies.
+    :param tuple cursor: Decoded cursor, see :py:func:`decode_cursor`.
+    :param int max_depth: Levels of replies to include below each comment.
+        Comments with replies below that level get a ``more_replies`` count
+        instead of ``replies``.
+    :param int reply_to: Id of the comment whose replies are paged, defaults
+        to the top-level comments.
+    :param int replies_limit: Maximum number of replies to include below
+        each comment. Comments with more replies get the newest
+        ``replies_limit`` of them, a ``more_replies`` count of the others
+        and a ``replies_cursor``, the cursor of the next page of their
+        replies.
+
+    The whole thread is fetched by :py:func:`get_comment_tree` if none of
+    the arguments are set, otherwise the page is fetched with one query and
+    the replies with another one, see :py:func:`get_replies_query`.
+    '''
+    if all(arg is None for arg in (limit, cursor, max_depth, reply_to,
+            replies_limit)):
+        return get_comment_tree(item), None
+
+    comments = get_thread_query(item).filter(Comment.reply_to_id == reply_to)
+
+    if cursor is not None:
+        created, comment_id = cursor
+        comments = comments.filter(or_(
+            Comment.created < created,
+            and_(Comment.created == created, Comment.id < comment_id)))
+
+    if limit is not None:
+        comments = comments.limit(limit + 1)
+
+    comments = comments.all()
+    next_cursor = None
+
+    if limit is not None and len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = encode_cursor(comments[-1])
+
+    comments_data = [comment.as_dict() for comment in comments]
+
+    if not comments:
+        return comments_data, next_cursor
+
+    if max_depth is not None and max_depth <= 0:
+        add_more_replies(dict((comment_dict['id'], comment_dict)
+            for comment_dict in comments_data))
+
+        return comments_data, next_cursor
+
+    parents = dict((comment_dict['id'], comment_dict)
+            for comment_dict in comments_data)
+    replies_index = defaultdict(list)
+    # The comments on the last level, which may have more replies
+    last_level = {}
+
+    for comment, position, reply_count in get_replies_query(comments,
+            max_depth, replies_limit):
+        if comment.reply_to_id not in parents:
+            # A reply below one of the replies that were left out
+            continue
+
+        comment_dict = comment.as_dict()
+        replies_index[comment.reply_to_id].append((position, comment_dict))
+        parents[comment.id] = comment_dict
+
+        if position == replies_limit and reply_count > replies_limit:
+            parents[comment.reply_to_id].update({
+                'more_replies': reply_count - replies_limit,
+                'replies_cursor': encode_cursor(comment)})
+
+        if max_depth is not None and \
+                comment.depth - comments[0].depth == max_depth:
+            last_level[comment.id] = comment_dict
+
+    for parent_id, replies in replies_index.items():
+        replies.sort()
+        parents[parent_id].update({
+            'replies': [comment_dict for position, comment_dict in replies]})
+
+    if last_level:
+        add_more_replies(last_level)
+
+    return comments_data, next_cursor
+
+
+def get_replies_query(comments, max_depth=None, replies_limit=None):
+    '''
+    Returns the query for the replies below ``comments``, down to
+    ``max_depth`` levels below them, with the comment authors joined.
+
+    The replies below each comment are selected by the prefix of their
+    materialized paths, see :py:meth:`Comment.get_subtree_prefix`, and come
+    in the order of the paths, each comment before its replies.
+
+    Each row holds the comment, its position among the replies to the same
+    comment, newest first and starting at 1, and the number of those
+    replies.
+
+    :param list comments: Comments on the same level of a thread
+    :param int max_depth: Levels of replies to include, defaults to all
+    :param int replies_limit: Leave out the replies after this position.
+        Their own replies are still part of the result and have to be left
+        out by the caller.
+    '''
+    subtrees = [match_prefix(Comment.path, comment.get_subtree_prefix())
+            for comment in comments]
+
+    ranked = db.session.query(
+            Comment.id.label('id'),
+            func.row_number().over(
+                partition_by=Comment.reply_to_id,
+                order_by=[Comment.created.desc(), Comment.id.desc()])\
+                    .label('position'),
+            func.count(Comment.id).over(partition_by=Comment.reply_to_id)\
+                    .label('reply_count'))\
+            .filter(or_(*subtrees))
+
+    if max_depth is not None:
+        ranked = ranked.filter(
+                Comment.depth <= comments[0].depth + max_depth)
+
+    ranked = ranked.subquery()
+
+    query = db.session.query(Comment, ranked.c.position, ranked.c.reply_count)\
+            .join(ranked, ranked.c.id == Comment.id)\
+            .options(joinedload(Comment.user))\
+            .order_by(Comment.path)
+
+    if replies_limit is not None:
+        query = query.filter(ranked.c.position <= replies_limit)
+
+    return query
+
+
+def add_more_replies(parents):
+    '''
+    Set the ``more_replies`` count on each of the ``parents`` comment dicts
+    that has replies, using a single grouped query.
+    '''
+    reply_counts = db.session.query(
+            Comment.reply_to_id,
+            func.count(Comment.id))\
+            .filter(Comment.reply_to_id.in_(parents.keys()))\
+            .group_by(Comment.reply_to_id)
+
+    for parent_id, reply_count in reply_counts:
+        parents[parent_id].update({'more_replies': reply_count})
+
+
+def get_thread_query(item):
+    '''
+    Returns the query for the comments on an item, newest first, with the
+    comment authors joined.
+    '''
+    return Comment.query.filter(Comment.item_id == item.id)\
+            .options(joinedload(Comment.user))\
+            .order_by(Comment.created.desc(), Comment.id.desc())
+
+
+def get_comment_tree(item):
+    '''
+    Fetch all comments on an item in one query and build the hierarchy of
+    replies in memory, using an index of comment id -> replies. The comment
+    authors are joined in the same query, so serializing the comments does
+    not issue any further queries.
+
+    Returns the top-level comments, each comment having a ``replies`` list
+    if it has been replied to. Comments are ordered newest first on every
+    level.
 
     Example:
-    >>> comment = Comment.query.first()
-    >>> comment_data = comment.as_dict()
-    >>> traverse_comments(commend_data, comment.replies.all())
-    >>> comment_data
-    {'created': '2012-09-09T15:08:06.193223',
+    >>> get_comment_tree(Item.query.first())
+    [{'created': datetime(2012, 9, 9, 15, 8, 6, 193223),
     'id': 58,
     'item': 29,
-    'replies': [{'created': '2012-09-09T15:09:40.084748',
+    'replies': [{'created': datetime(2012, 9, 9, 15, 9, 40, 84748),
         'id': 59,
         'item': 29,
         'reply_to': 58,
@@ -119,14 +602,18 @@ def traverse_comments(parent_dict, replies):
     'reply_to': None,
     'text': u'And remove the old comments!',
     'user_id': 1,
-    'username': u'joar'}
-    '''
-    if replies:
-        replies_data = []
-        parent_dict.update({'replies': replies_data})
-        for comment in replies:
-            comment_dict = comment.as_dict()
-            replies_data.append(comment_dict)
-            replies = comment.replies.order_by(Comment.created.desc()).all()
-            if len(replies):
-                traverse_comments(comment_dict, replies)
+    'username': u'joar'}]
+    '''
+    replies_index = defaultdict(list)
+
+    for comment in get_thread_query(item):
+        replies_index[comment.reply_to_id].append(comment.as_dict())
+
+    for comments_data in replies_index.values():
+        for comment_dict in comments_data:
+            replies = replies_index.get(comment_dict['id'])
+
+            if replies:
+                comment_dict.update({'replies': replies})
+
+    return replies_index[None]
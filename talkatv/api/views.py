@@ -16,21 +16,23 @@
 
 from flask import request, json, abort, g
 
-from talkatv import app
+from talkatv import app, db
 from talkatv.decorators import require_active_login
 from talkatv.models import Item
-from talkatv.tools.cors import jsonify, allow_all_origins
-from talkatv.item import get_or_add_item
-from talkatv.api import get_context, post_comment
+from talkatv.tools.auth import get_active_user
+from talkatv.tools.cors import jsonify, stream_jsonify, not_modified, \
+        allow_configured_origins
+from talkatv.item import get_or_add_item, canonicalize_url, get_url_hash
+from talkatv.api import get_thread, cache_thread, get_cached_context, \
+        get_page_args, add_user_context, get_etag, post_comment, \
+        should_stream, iter_thread_json
 
 
-@app.route('/api/comments', methods=['GET', 'POST', 'OPTIONS'])
+@app.route('/api/comments', methods=['GET', 'POST'])
 @require_active_login(['POST'])
 def api_comments():
-    if request.method == 'OPTIONS':
-        # We're dealing with a pre-flight request
-        return jsonify(status='OK', _allow_origin_cb=allow_all_origins)
-
+    # Pre-flight requests are answered by
+    # talkatv.tools.cors.PreflightMiddleware
     if request.method == 'POST':
         post_data = json.loads(request.data)
 
@@ -39,29 +41,96 @@ def api_comments():
         if not item:
             return abort(404)
 
-        comment = post_comment(item, post_data, g.user)
+        comment = post_comment(item, post_data, get_active_user())
 
         return jsonify(
                 comment=comment.as_dict(),
                 status='OK',
-                _allow_origin_cb=allow_all_origins)
+                _allow_origin_cb=allow_configured_origins)
+
+    item_url = request.args.get('item_url')
 
-    if not request.args.get('item_url'):
+    if not item_url:
         return abort(404)
 
-    item = get_or_add_item(
-            request.args.get('item_url'),
-            request.args.get('item_title'))
+    thread = get_thread(item_url)
+    item = None
+
+    if thread is None:
+        item = get_or_add_item(item_url, request.args.get('item_title'))
+        thread = cache_thread(item_url, item)
+
+    page_args = get_page_args(request.args)
+
+    etag = get_etag(thread, request.query_string)
 
-    return_data = get_context(item)
+    # Compressed responses carry the ETag as a weak one
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(
+                _allow_origin_cb=allow_configured_origins,
+                _etag=etag,
+                _last_modified=thread['modified'])
 
-    return jsonify(_allow_origin_cb=allow_all_origins,
+    if should_stream(thread, page_args):
+        if item is None:
+            item = Item.query.get(thread['item_id'])
+
+        return stream_jsonify(
+                iter_thread_json(item, add_user_context({})),
+                _allow_origin_cb=allow_configured_origins,
+                _etag=etag,
+                _last_modified=thread['modified'])
+
+    return_data = add_user_context(
+            get_cached_context(thread, page_args, item))
+
+    return jsonify(_allow_origin_cb=allow_configured_origins,
+            _etag=etag,
+            _last_modified=thread['modified'],
             **return_data)
 
 
-@app.route('/api/check-login', methods=['GET', 'OPTIONS'])
+@app.route('/api/check-login')
 def check_login():
     if g.user:
-        return jsonify(status='OK', _allow_origin_cb=allow_all_origins)
+        return jsonify(status='OK', _allow_origin_cb=allow_configured_origins)
     else:
-        return jsonify(status=False, _allow_origin_cb=allow_all_origins)
+        return jsonify(status=False, _allow_origin_cb=allow_configured_origins)
+
+
+@app.route('/api/counts')
+def api_counts():
+    '''
+    Returns the number of comments on each of the ``url`` arguments, e.g.
+    ``/api/counts?url=http://example.org/a&url=http://example.org/b``.
+
+    Unknown URLs are counted as having no comments, no items are added. The
+    URLs are canonicalized without the rules of their sites, see
+    :py:func:`talkatv.item.canonicalize_url`.
+    '''
+    urls = request.args.getlist('url')
+
+    if len(urls) > app.config['COUNTS_MAX_URLS']:
+        return abort(400)
+
+    counts = dict.fromkeys(urls, 0)
+    hashes = {}
+
+    for url in urls:
+        hashes.setdefault(get_url_hash(canonicalize_url(url)), []).append(url)
+
+    if hashes:
+        for url_hash, comment_count in db.session.query(
+                Item.url_hash, Item.comment_count)\
+                        .filter(Item.url_hash.in_(hashes.keys())):
+            for url in hashes[url_hash]:
+                counts[url] = comment_count or 0
+
+    response = jsonify(counts=counts,
+            _allow_origin_cb=allow_configured_origins)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['COUNTS_MAX_AGE']
+    response.add_etag()
+
+    return response.make_conditional(request)
@@ -14,11 +14,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+
 from markdown import Markdown
 
 from lxml.html.clean import Cleaner
 
-MARKDOWN = Markdown(output_format='xhtml5')
+# Markdown instances keep state between conversions and may not be shared
+# between threads, each thread gets its own instance.
+_local = threading.local()
+
+#: Bump this whenever a change to :py:func:`parse_comment` alters its output,
+#: comments rendered by an older version are re-rendered when read. Run
+#: ``rerender.py`` to update the stored HTML.
+RENDERER_VERSION = 1
 
 HTML_CLEANER = Cleaner(
     scripts=True,
@@ -42,10 +51,40 @@ HTML_CLEANER = Cleaner(
     whitelist_tags=set())
 
 
+def get_markdown():
+    '''
+    Returns the :py:class:`markdown.Markdown` instance of the current thread,
+    creating it on first use.
+    '''
+    markdown = getattr(_local, 'markdown', None)
+
+    if markdown is None:
+        markdown = _local.markdown = Markdown(output_format='xhtml5')
+
+    return markdown
+
+
 def parse_comment(comment):
-    if comment:
-        html = MARKDOWN.convert(comment)
-        clean_html = HTML_CLEANER.clean_html(html)
-        return clean_html
-    else:
-        return ''
+    return parse_comments([comment])[0]
+
+
+def parse_comments(comments):
+    '''
+    Render a list of comment texts to sanitized HTML, reusing one Markdown
+    instance for all of them.
+
+    :param list comments: comment texts
+    :rtype: list of HTML strings, in the same order as ``comments``
+    '''
+    markdown = get_markdown()
+    rendered = []
+
+    for comment in comments:
+        if comment:
+            markdown.reset()
+            html = markdown.convert(comment)
+            rendered.append(HTML_CLEANER.clean_html(html))
+        else:
+            rendered.append('')
+
+    return rendered
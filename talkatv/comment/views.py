@@ -19,6 +19,7 @@ from flask import render_template, abort, request, redirect, url_for
 from talkatv import app
 from talkatv.models import Item
 from talkatv.api import get_context
+from talkatv.item import get_item
 
 
 @app.route('/comment/list/<int:item_id>')
@@ -33,7 +34,7 @@ def comment_list(item_id=None):
             return abort(404)
     else:
         if request.args.get('url'):
-            item = Item.query.filter_by(url=request.args.get('url')).first()
+            item = get_item(request.args.get('url'))
 
             app.logger.debug('item by args[\'url\']: {0}'.format(item))
 
@@ -41,8 +42,7 @@ def comment_list(item_id=None):
                 return redirect(url_for('comment_list', item_id=item.id))
 
         elif request.headers.get('Referer'):
-            item = Item.query.filter_by(url=request.headers.get('Referer'))\
-                    .first()
+            item = get_item(request.headers.get('Referer'))
 
             if item:
                 return redirect(url_for('comment_list', item_id=item.id))
@@ -19,11 +19,23 @@ from pywebfinger import finger
 from flask import g
 
 from flask.ext.wtf import Form, html5, TextField, PasswordField, HiddenField, \
-        validators
-from talkatv.models import User, Item, Comment, OpenID
+        SelectField, validators
+from talkatv.models import User, Comment, OpenID
+from talkatv.item import get_item
 from talkatv.tools.redirect import RedirectForm
 
 
+def int_or_none(value):
+    '''
+    Coerce the value of a select field to an int, or to ``None``, which is
+    rendered as ``'None'``.
+    '''
+    if value is None or value == 'None':
+        return None
+
+    return int(value)
+
+
 class RegistrationForm(Form):
     username = TextField('Username', [validators.Required()])
     password = PasswordField('Password', [validators.Optional()])
@@ -57,6 +69,15 @@ class ProfileForm(Form):
     username = TextField('Username', [validators.Required()])
     email = html5.EmailField('Email', [validators.Required()])
     openid = html5.URLField('OpenID', [validators.Optional()])
+    #: The windows are stored in seconds, ``None`` is the
+    #: ``NOTIFICATION_DIGEST_WINDOW`` of the site
+    notification_window = SelectField('Notifications', coerce=int_or_none,
+            choices=[
+                (None, 'Site default'),
+                (0, 'Right away'),
+                (600, 'Every 10 minutes'),
+                (3600, 'Every hour'),
+                (86400, 'Once a day')])
 
     def __init__(self, *args, **kw):
         Form.__init__(self, *args, **kw)
@@ -119,7 +140,7 @@ class ItemForm(Form):
         if not Form.validate(self):
             return False
 
-        item = Item.query.filter_by(url=self.url.data).first()
+        item = get_item(self.url.data)
 
         if item is not None:
             self.url.errors.append('That URL already exists')
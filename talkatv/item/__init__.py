@@ -14,48 +14,215 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from urlparse import urlparse
-from talkatv import db
+import hashlib
+import re
+import urllib
+
+from fnmatch import fnmatch
+from operator import itemgetter
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from talkatv import app, db
 from talkatv.models import Item, Site
+from talkatv.tools.query import match_prefix
+
+DEFAULT_PORTS = {
+        'http': 80,
+        'https': 443}
+
+
+def canonicalize_url(url, site=None):
+    '''
+    Returns the canonical form of an item URL, so that the variants of a page
+    URL all map to the same item:
+
+    - The scheme and host are lower case and the default port is removed
+    - The fragment is removed
+    - A trailing slash is removed from the path
+    - Query parameters matching one of the ``ITEM_URL_IGNORED_PARAMS``
+      patterns, or one of the ``ignored_params`` of ``site``, are removed
+      and the remaining parameters are sorted by name
+
+    http and https URLs keep their scheme, but share the same hash, see
+    :py:func:`get_url_hash`.
+
+    :param str url: page URL
+    :param Site site: site of the page, for its rules
+    '''
+    ignored_params = list(app.config['ITEM_URL_IGNORED_PARAMS'])
+
+    if site is not None:
+        ignored_params.extend(get_ignored_params(site))
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+
+    try:
+        host = (parts.hostname or '').rstrip('.')
+        port = parts.port
+    except ValueError:
+        # Invalid port number, leave the netloc as it is
+        pass
+    else:
+        netloc = host
+
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            netloc += ':{0}'.format(port)
+
+    path = parts.path.rstrip('/') or '/'
+
+    params = [(name, value)
+            for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not any(fnmatch(name, pattern) for pattern in ignored_params)]
+    query = urllib.urlencode(sorted(params, key=itemgetter(0)))
+
+    return urlunsplit((scheme, netloc, path, query, '')).decode('utf-8')
+
+
+def get_url_hash(url):
+    '''
+    Returns the fixed-width key items are looked up by, the hex SHA-1 of the
+    canonical URL without its scheme.
+
+    :param str url: canonical URL, see :py:func:`canonicalize_url`
+    '''
+    return hashlib.sha1(
+            url.split('://', 1)[-1].encode('utf-8')).hexdigest()
+
+
+def get_ignored_params(site):
+    '''
+    Returns the list of query parameter patterns ignored on ``site``.
+    '''
+    if not site.ignored_params:
+        return []
+
+    return re.split(r'[\s,]+', site.ignored_params.strip())
+
+
+def get_item(url, site=None):
+    '''
+    Returns the item for a page URL, or None.
+
+    The per-site rules only apply if ``site`` is passed, see
+    :py:func:`get_or_add_item`.
+    '''
+    return Item.query.filter(
+            Item.url_hash == get_url_hash(canonicalize_url(url, site)))\
+                    .first()
 
 
 def get_or_add_item(url, title=None):
     '''
     Get an item, add it if it doesn't exist.
 
+    The URL is canonicalized, see :py:func:`canonicalize_url`. Items are
+    first looked up without the rules of their site, which only takes a
+    single query for most pages, the site is only looked up if that fails.
+
+    Several requests may try to add the same item at once, e.g. when a new
+    page is first loaded by many readers. Only one of the inserts succeeds,
+    the others fail on the unique URL hash constraint and roll back, then
+    select the item that was added. Any uncommitted changes in the session
+    are lost in that case, so call this before making any.
+
     :param str url: item `URL`
     :param str title: item `title`
     '''
-    item = Item.query.filter(Item.url == url).first()
+    item = get_item(url)
 
     if not item:
-        url_data = urlparse(url)
-
-        # Get the parts of the domain, e.g. ['www', 'wandborg', 'se']
-        # account for netlocs with a port number, e.g. wandborg.se:4547 by
-        # removing that part before
-        netloc_split = url_data.netloc.split(':')[0].split('.')
-
-        site = None
-
-        # Find a start position that is not further back than 7. This to prevent
-        # malicious users from submitting '.a.a.a.a.a.a.a.a.a.a' * 7000 in an
-        # attempt to overload the database.
-        start = - (len(netloc_split) if len(netloc_split) < 8 else 7)
-        # Addresses that are higher up than the second level can be safely
-        # accounted for as invalid.
-        stop = -2
-
-        # Try to find a registered site for this item. Step through the URL
-        for i in range(start, stop):
-            site = Site.query.filter(Site.domain == '.'.join(netloc_split[i:]))\
-                    .first()
+        site = get_site_for_host(urlsplit(url).netloc)
 
-            if site is not None:
-                break
+        if site is not None and site.ignored_params:
+            item = get_item(url, site)
 
-        item = Item(url, title, site)
+    if not item:
+        url = canonicalize_url(url, site)
+        url_hash = get_url_hash(url)
+
+        item = Item(url, title, site, url_hash)
         db.session.add(item)
-        db.session.commit()
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            item = Item.query.filter(Item.url_hash == url_hash).one()
 
     return item
+
+
+def get_site_for_host(netloc):
+    '''
+    Returns the registered site for a host, or None. The site with the
+    longest domain that is either the host itself or one of its parent
+    domains wins, e.g. for ``www.wandborg.se`` a site for ``www.wandborg.se``
+    is preferred over one for ``wandborg.se``.
+
+    All candidate domains are looked up with a single query.
+
+    :param str netloc: host name, optionally with a port number
+    '''
+    # Get the parts of the domain, e.g. ['www', 'wandborg', 'se']
+    # account for netlocs with a port number, e.g. wandborg.se:4547 by
+    # removing that part before
+    netloc_split = netloc.split(':')[0].lower().split('.')
+
+    # Find a start position that is not further back than 7. This to prevent
+    # malicious users from submitting '.a.a.a.a.a.a.a.a.a.a' * 7000 in an
+    # attempt to overload the database.
+    start = - (len(netloc_split) if len(netloc_split) < 8 else 7)
+    # Addresses that are higher up than the second level can be safely
+    # accounted for as invalid.
+    stop = -1
+
+    domains = ['.'.join(netloc_split[i:]) for i in range(start, stop)]
+
+    if not domains:
+        return None
+
+    return Site.query.filter(Site.domain.in_(domains))\
+            .order_by(func.length(Site.domain).desc())\
+            .first()
+
+
+def assign_items_to_site(site):
+    '''
+    Register the items on the domain of ``site``, and its subdomains, as
+    belonging to the site, with a single ``UPDATE``. Items that belong to a
+    site for a more specific domain are left alone, like in
+    :py:func:`get_site_for_host`.
+
+    The items are found by the prefix of their reversed host names, see
+    :py:meth:`talkatv.models.Item.reverse_host` and
+    :py:func:`talkatv.tools.query.match_prefix`.
+
+    The version of the items is incremented, since their data changes.
+    The update is part of the current transaction, it's up to the caller to
+    commit it, and then to remove the cached threads of the items, see
+    :py:func:`talkatv.api.forget_threads`.
+
+    :param Site site: a site with an id, i.e. flushed to the database
+    :rtype: number of assigned items
+    '''
+    more_specific_sites = select([Site.id]).where(
+            func.length(Site.domain) > len(site.domain))
+
+    result = db.session.execute(Item.__table__.update()\
+            .where(match_prefix(Item.reversed_host,
+                Item.reverse_host(site.domain)))\
+            .where(or_(
+                Item.site_id == None,
+                ~Item.site_id.in_(more_specific_sites)))\
+            .values(site_id=site.id, version=Item.version + 1))
+
+    return result.rowcount
+
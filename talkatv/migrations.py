@@ -14,13 +14,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from urlparse import urlsplit
+
 from mig import RegisterMigration
 
-from sqlalchemy import MetaData, Table, Column, Integer, Unicode, DateTime, \
-        ForeignKey
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, \
+        Unicode, DateTime, ForeignKey, select, func, bindparam
 
 MIGRATIONS = {}
 
+#: Number of rows that data migrations update at a time
+BATCH_SIZE = 1000
+
 
 @RegisterMigration(1, MIGRATIONS)
 def create_site_table(db_conn):
@@ -81,3 +86,369 @@ def comment_add_reply_to_id(db):
     reply_to_column.create(comment_table)
 
     db.commit()
+
+
+@RegisterMigration(5, MIGRATIONS)
+def comment_add_html(db):
+    metadata = MetaData(bind=db.bind)
+
+    comment_table = Table('comment', metadata, autoload=True)
+
+    html_column = Column('html', Unicode)
+    html_column.create(comment_table)
+
+    html_version_column = Column('html_version', Integer)
+    html_version_column.create(comment_table)
+
+    db.commit()
+
+
+@RegisterMigration(6, MIGRATIONS)
+def item_add_version_last_comment_at(db):
+    metadata = MetaData(bind=db.bind)
+
+    item_table = Table('item', metadata, autoload=True)
+    comment_table = Table('comment', metadata, autoload=True)
+
+    version_column = Column('version', Integer, default=0)
+    version_column.create(item_table, populate_default=True)
+
+    last_comment_at_column = Column('last_comment_at', DateTime)
+    last_comment_at_column.create(item_table)
+
+    db.execute(item_table.update().values(
+        last_comment_at=select([func.max(comment_table.c.created)])\
+                .where(comment_table.c.item_id == item_table.c.id)\
+                .as_scalar()))
+
+    db.commit()
+
+
+@RegisterMigration(7, MIGRATIONS)
+def item_add_comment_count(db):
+    metadata = MetaData(bind=db.bind)
+
+    item_table = Table('item', metadata, autoload=True)
+    comment_table = Table('comment', metadata, autoload=True)
+
+    comment_count_column = Column('comment_count', Integer, default=0)
+    comment_count_column.create(item_table, populate_default=True)
+
+    db.execute(item_table.update().values(
+        comment_count=select([func.count(comment_table.c.id)])\
+                .where(comment_table.c.item_id == item_table.c.id)\
+                .as_scalar()))
+
+    db.commit()
+
+
+@RegisterMigration(8, MIGRATIONS)
+def create_notification_table(db):
+    metadata = MetaData(bind=db.bind)
+
+    comment_table = Table('comment', metadata, autoload=True)
+
+    notification_table = Table('notification', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('created', DateTime),
+            Column('recipient', Unicode(255)),
+            Column('subject', Unicode),
+            Column('body', Unicode),
+            Column('send_after', DateTime),
+            Column('sent', DateTime),
+            Column('attempts', Integer, default=0),
+            Column('last_error', Unicode),
+            Column('comment_id', Integer, ForeignKey(
+                comment_table.columns['id'])))
+
+    notification_table.create()
+
+    db.commit()
+
+
+@RegisterMigration(9, MIGRATIONS)
+def add_notification_digests(db):
+    metadata = MetaData(bind=db.bind)
+
+    user_table = Table('user', metadata, autoload=True)
+    notification_table = Table('notification', metadata, autoload=True)
+
+    notification_window_column = Column('notification_window', Integer)
+    notification_window_column.create(user_table)
+
+    user_id_column = Column('user_id', Integer, ForeignKey(
+        user_table.columns['id']))
+    user_id_column.create(notification_table)
+
+    db.execute(notification_table.update().values(
+        user_id=select([user_table.c.id])\
+                .where(user_table.c.email == notification_table.c.recipient)\
+                .as_scalar()))
+
+    db.commit()
+
+
+@RegisterMigration(10, MIGRATIONS)
+def item_add_url_hash(db):
+    '''
+    Canonicalize the item URLs and merge the items that share a canonical
+    URL. The comments of the merged items are moved to the oldest one.
+
+    The items are read with a server-side cursor where the database supports
+    it, and updated in batches. The hashes are stored first, then the items
+    that share a hash are merged, and only then are the URLs canonicalized,
+    as they are unique.
+    '''
+    from talkatv.item import canonicalize_url, get_url_hash
+
+    metadata = MetaData(bind=db.bind)
+
+    item_table = Table('item', metadata, autoload=True)
+    site_table = Table('site', metadata, autoload=True)
+    comment_table = Table('comment', metadata, autoload=True)
+
+    url_hash_column = Column('url_hash', String(40))
+    url_hash_column.create(item_table)
+
+    ignored_params_column = Column('ignored_params', Unicode)
+    ignored_params_column.create(site_table)
+
+    def update_batches(update, values):
+        batch = []
+
+        for row_values in values:
+            batch.append(row_values)
+
+            if len(batch) == BATCH_SIZE:
+                db.execute(update, batch)
+                batch = []
+
+        if batch:
+            db.execute(update, batch)
+
+    def iter_urls():
+        rows = db.execute(select([item_table.c.id, item_table.c.url])\
+                .where(item_table.c.url != None)\
+                .execution_options(stream_results=True))
+
+        for row in rows:
+            yield row.id, row.url, canonicalize_url(row.url)
+
+    update_batches(
+            item_table.update()\
+                    .where(item_table.c.id == bindparam('item_id'))\
+                    .values(url_hash=bindparam('url_hash')),
+            ({'item_id': item_id, 'url_hash': get_url_hash(url)}
+                for item_id, _, url in iter_urls()))
+
+    duplicated_hashes = db.execute(select([item_table.c.url_hash])\
+            .where(item_table.c.url_hash != None)\
+            .group_by(item_table.c.url_hash)\
+            .having(func.count(item_table.c.id) > 1)).fetchall()
+
+    for (url_hash,) in duplicated_hashes:
+        merged = db.execute(select([
+                item_table.c.id,
+                item_table.c.comment_count,
+                item_table.c.last_comment_at])\
+                        .where(item_table.c.url_hash == url_hash)\
+                        .order_by(item_table.c.id)).fetchall()
+        item, duplicates = merged[0], merged[1:]
+        duplicate_ids = [row.id for row in duplicates]
+
+        db.execute(comment_table.update()\
+                .where(comment_table.c.item_id.in_(duplicate_ids))\
+                .values(item_id=item.id))
+
+        db.execute(item_table.delete()\
+                .where(item_table.c.id.in_(duplicate_ids)))
+
+        db.execute(item_table.update()\
+                .where(item_table.c.id == item.id)\
+                .values(
+                    comment_count=sum(row.comment_count or 0
+                        for row in merged),
+                    last_comment_at=max([row.last_comment_at
+                        for row in merged
+                        if row.last_comment_at is not None] or [None]),
+                    version=item_table.c.version + 1))
+
+    update_batches(
+            item_table.update()\
+                    .where(item_table.c.id == bindparam('item_id'))\
+                    .values(url=bindparam('canonical_url')),
+            ({'item_id': item_id, 'canonical_url': canonical_url}
+                for item_id, url, canonical_url in iter_urls()
+                if url != canonical_url))
+
+    Index('ix_item_url_hash', item_table.c.url_hash, unique=True)\
+            .create(db.connection())
+
+    db.commit()
+
+
+@RegisterMigration(11, MIGRATIONS)
+def item_add_host(db):
+    metadata = MetaData(bind=db.bind)
+
+    item_table = Table('item', metadata, autoload=True)
+
+    host_column = Column('host', Unicode)
+    host_column.create(item_table)
+
+    for row in db.execute(select([item_table.c.id, item_table.c.url]))\
+            .fetchall():
+        if row.url is None:
+            continue
+
+        db.execute(item_table.update()\
+                .where(item_table.c.id == row.id)\
+                .values(host=urlsplit(row.url).hostname))
+
+    Index('ix_item_host', item_table.c.host).create(db.connection())
+
+    db.commit()
+
+
+@RegisterMigration(12, MIGRATIONS)
+def add_secondary_indexes(db):
+    '''
+    Index the foreign keys and the columns that threads, site lookups,
+    OpenID logins and the notification outbox are queried by.
+    '''
+    metadata = MetaData(bind=db.bind)
+
+    comment_table = Table('comment', metadata, autoload=True)
+    item_table = Table('item', metadata, autoload=True)
+    site_table = Table('site', metadata, autoload=True)
+    openid_table = Table('openID', metadata, autoload=True)
+    notification_table = Table('notification', metadata, autoload=True)
+
+    indexes = [
+            Index('ix_comment_item_id_reply_to_id_created',
+                comment_table.c.item_id,
+                comment_table.c.reply_to_id,
+                comment_table.c.created),
+            Index('ix_comment_reply_to_id', comment_table.c.reply_to_id),
+            Index('ix_comment_user_id', comment_table.c.user_id),
+            Index('ix_item_created', item_table.c.created),
+            Index('ix_item_site_id', item_table.c.site_id),
+            Index('ix_site_domain', site_table.c.domain),
+            Index('ix_site_owner_id', site_table.c.owner_id),
+            Index('ix_openID_url', openid_table.c.url),
+            Index('ix_openID_user_id', openid_table.c.user_id),
+            Index('ix_notification_sent_send_after',
+                notification_table.c.sent,
+                notification_table.c.send_after),
+            Index('ix_notification_comment_id',
+                notification_table.c.comment_id),
+            Index('ix_notification_user_id', notification_table.c.user_id)]
+
+    for index in indexes:
+        index.create(db.connection())
+
+    db.commit()
+
+
+@RegisterMigration(13, MIGRATIONS)
+def comment_add_path(db):
+    '''
+    Add the materialized path and depth of the comments. The paths are
+    computed one level of the threads at a time, in batches, as the path of
+    a reply contains the path of the comment it replies to.
+    '''
+    from talkatv.models import Comment
+
+    metadata = MetaData(bind=db.bind)
+
+    comment_table = Table('comment', metadata, autoload=True)
+
+    Column('path', String).create(comment_table)
+    Column('depth', Integer).create(comment_table)
+
+    parent_table = comment_table.alias('parent')
+
+    top_level = select([comment_table.c.id])\
+            .where(comment_table.c.path == None)\
+            .where(comment_table.c.reply_to_id == None)
+
+    replies = select([
+            comment_table.c.id,
+            parent_table.c.path,
+            parent_table.c.depth])\
+            .select_from(comment_table.join(parent_table,
+                comment_table.c.reply_to_id == parent_table.c.id))\
+            .where(comment_table.c.path == None)\
+            .where(parent_table.c.path != None)
+
+    update = comment_table.update()\
+            .where(comment_table.c.id == bindparam('comment_id'))\
+            .values(path=bindparam('path'), depth=bindparam('depth'))
+
+    def update_batches(query, make_values):
+        while True:
+            rows = db.execute(query.limit(BATCH_SIZE)).fetchall()
+
+            if not rows:
+                break
+
+            db.execute(update, [make_values(row) for row in rows])
+
+    update_batches(top_level, lambda row: {
+        'comment_id': row.id,
+        'path': Comment.make_path(row.id),
+        'depth': 0})
+
+    # Each batch of replies is below comments that already have a path
+    update_batches(replies, lambda row: {
+        'comment_id': row.id,
+        'path': Comment.make_path(row.id, row.path),
+        'depth': row.depth + 1})
+
+    Index('ix_comment_path', comment_table.c.path,
+            postgresql_ops={'path': 'varchar_pattern_ops'})\
+            .create(db.connection())
+
+    db.commit()
+
+
+@RegisterMigration(14, MIGRATIONS)
+def item_add_reversed_host(db):
+    '''
+    Add the reversed host names of the items, in batches, and index them
+    instead of the host names.
+    '''
+    from talkatv.models import Item
+
+    metadata = MetaData(bind=db.bind)
+
+    item_table = Table('item', metadata, autoload=True)
+
+    Column('reversed_host', String).create(item_table)
+
+    missing = select([item_table.c.id, item_table.c.host])\
+            .where(item_table.c.reversed_host == None)\
+            .where(item_table.c.host != None)\
+            .limit(BATCH_SIZE)
+
+    update = item_table.update()\
+            .where(item_table.c.id == bindparam('item_id'))\
+            .values(reversed_host=bindparam('reversed_host'))
+
+    while True:
+        rows = db.execute(missing).fetchall()
+
+        if not rows:
+            break
+
+        db.execute(update, [{
+            'item_id': row.id,
+            'reversed_host': Item.reverse_host(row.host)}
+            for row in rows])
+
+    Index('ix_item_reversed_host', item_table.c.reversed_host,
+            postgresql_ops={'reversed_host': 'varchar_pattern_ops'})\
+            .create(db.connection())
+    Index('ix_item_host', item_table.c.host).drop(db.connection())
+
+    db.commit()
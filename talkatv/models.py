@@ -17,12 +17,13 @@
 import bcrypt
 
 from datetime import datetime
+from urlparse import urlsplit
 
 from migrate import changeset
 assert changeset  # silence code analysers
 
 from talkatv import db
-from talkatv.comment import parse_comment
+from talkatv.comment import parse_comment, RENDERER_VERSION
 
 
 class User(db.Model):
@@ -30,6 +31,9 @@ class User(db.Model):
     username = db.Column(db.String(60), unique=True)
     email = db.Column(db.String(255), unique=True)
     password = db.Column(db.String(60))
+    #: Seconds to collect notifications for before they are sent as one
+    #: digest, None to use ``NOTIFICATION_DIGEST_WINDOW``
+    notification_window = db.Column(db.Integer)
 
     def __init__(self, username, email, password=None, openid=None):
         self.username = username
@@ -53,10 +57,10 @@ class User(db.Model):
 
 class OpenID(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    url = db.Column(db.String())
+    url = db.Column(db.String(), index=True)
     created = db.Column(db.DateTime)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User',
             backref=db.backref('openids', lazy='dynamic'))
 
@@ -67,23 +71,59 @@ class OpenID(db.Model):
 
 
 class Item(db.Model):
+    __table_args__ = (
+            # The items of a site and its subdomains, matched by a prefix of
+            # the reversed host, see talkatv.tools.query.match_prefix
+            db.Index('ix_item_reversed_host', 'reversed_host',
+                postgresql_ops={'reversed_host': 'varchar_pattern_ops'}),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String())
     url = db.Column(db.String(), unique=True)
-    created = db.Column(db.DateTime)
-
-    site_id = db.Column(db.Integer, db.ForeignKey('site.id'))
+    #: Hash of the canonical URL, see :py:func:`talkatv.item.get_url_hash`
+    url_hash = db.Column(db.String(40), unique=True, index=True)
+    #: Host name of the URL
+    host = db.Column(db.String)
+    #: Host name of the URL with its labels reversed, used to find the items
+    #: of a site, see :py:meth:`reverse_host`
+    reversed_host = db.Column(db.String)
+    created = db.Column(db.DateTime, index=True)
+    #: Incremented every time a comment is posted on the item
+    version = db.Column(db.Integer, default=0)
+    #: Number of comments on the item, including replies
+    comment_count = db.Column(db.Integer, default=0)
+    last_comment_at = db.Column(db.DateTime)
+
+    site_id = db.Column(db.Integer, db.ForeignKey('site.id'), index=True)
     site = db.relationship('Site',
             backref=db.backref('items', lazy='dynamic'))
 
-    def __init__(self, url, title, site=None):
+    def __init__(self, url, title, site=None, url_hash=None):
         if site:
             self.site = site
 
         self.title = title
         self.url = url
+        self.url_hash = url_hash
+        self.host = urlsplit(url).hostname
+        self.reversed_host = self.reverse_host(self.host)
 
         self.created = datetime.utcnow()
+        self.version = 0
+        self.comment_count = 0
+
+    @staticmethod
+    def reverse_host(host):
+        '''
+        Returns the labels of ``host`` in reverse order, followed by a dot,
+        e.g. ``se.wandborg.www.`` for ``www.wandborg.se``. The reversed names
+        of a domain and all of its subdomains start with the reversed name of
+        the domain.
+        '''
+        if host is None:
+            return None
+
+        return '.'.join(reversed(host.lower().split('.'))) + '.'
 
     def __repr__(self):
         return '<Item {0} ({1})>'.format(
@@ -95,25 +135,37 @@ class Item(db.Model):
                 'id': self.id,
                 'title': self.title,
                 'url': self.url,
-                'created': self.created.isoformat()}
+                'created': self.created}
         if self.site:
-            me.update({'owner': self.site.owner.id})
+            me.update({'owner': self.site.owner_id})
 
         return me
 
+    @property
+    def modified(self):
+        '''
+        The time of the last change to the item's comment thread.
+        '''
+        return self.last_comment_at or self.created
+
 
 class Site(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime)
-    domain = db.Column(db.String)
+    domain = db.Column(db.String, index=True)
+    #: Query parameters to ignore in the item URLs of the site, separated by
+    #: spaces or commas. Shell-style wildcards are allowed, ``*`` ignores the
+    #: whole query string.
+    ignored_params = db.Column(db.String)
 
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     owner = db.relationship('User',
             backref=db.backref('sites', lazy='dynamic'))
 
-    def __init__(self, owner, domain):
+    def __init__(self, owner, domain, ignored_params=None):
         self.owner = owner
         self.domain = domain
+        self.ignored_params = ignored_params
 
         self.created = datetime.utcnow()
 
@@ -124,22 +176,47 @@ class Site(db.Model):
 
 
 class Comment(db.Model):
+    __table_args__ = (
+            # The comments on each level of a thread, newest first
+            db.Index('ix_comment_item_id_reply_to_id_created',
+                'item_id', 'reply_to_id', 'created'),
+            # The replies below a comment, matched by a prefix of their paths,
+            # see talkatv.tools.query.match_prefix
+            db.Index('ix_comment_path', 'path',
+                postgresql_ops={'path': 'varchar_pattern_ops'}),)
+
+    #: Format of each comment id in :py:attr:`path`. The ids are zero-padded
+    #: so that the paths sort in the order of the tree.
+    PATH_FORMAT = '{0:010d}'
+    #: Separator between the ids in :py:attr:`path`
+    PATH_SEPARATOR = '.'
+
     id = db.Column(db.Integer, primary_key=True)
     created = db.Column(db.DateTime)
     text = db.Column(db.String())
+    html = db.Column(db.String())
+    html_version = db.Column(db.Integer)
 
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
     item = db.relationship('Item',
             backref=db.backref('comments', lazy='dynamic'))
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User',
             backref=db.backref('comments', lazy='dynamic'))
 
-    reply_to_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    reply_to_id = db.Column(db.Integer, db.ForeignKey('comment.id'),
+            index=True)
     reply_to = db.relationship('Comment', remote_side=[id],
             backref=db.backref('replies', lazy='dynamic'))
 
+    #: Materialized path, the ids of the top-level comment, the comments
+    #: replied to and the comment itself. All replies below a comment are
+    #: fetched with one index scan, see :py:meth:`get_subtree_prefix`.
+    path = db.Column(db.String)
+    #: Number of comments replied to above this one, 0 for top-level comments
+    depth = db.Column(db.Integer)
+
     def __init__(self, item, user, text, reply_to=None):
         self.item = item
         self.user = user
@@ -158,21 +235,125 @@ class Comment(db.Model):
                 self.text[:25] + ('...' if len(self.text) > 25 else ''),
                 self.user.username)
 
+    @classmethod
+    def make_path(cls, comment_id, parent_path=None):
+        '''
+        Returns the materialized path of a comment, below the comment with
+        path ``parent_path`` if it is a reply.
+        '''
+        path = cls.PATH_FORMAT.format(comment_id)
+
+        if parent_path is None:
+            return path
+
+        return parent_path + cls.PATH_SEPARATOR + path
+
+    def set_path(self):
+        '''
+        Set :py:attr:`path` and :py:attr:`depth`. The comment has to be
+        flushed first, so that it has an id.
+        '''
+        if self.reply_to is None:
+            self.path = self.make_path(self.id)
+            self.depth = 0
+        else:
+            self.path = self.make_path(self.id, self.reply_to.path)
+            self.depth = self.reply_to.depth + 1
+
+    def get_subtree_prefix(self):
+        '''
+        Returns the prefix of the paths of all replies below this comment, at
+        any depth.
+        '''
+        return self.path + self.PATH_SEPARATOR
+
+    def render(self):
+        '''
+        Render the comment text and store the resulting HTML on the comment,
+        stamped with the current :py:data:`talkatv.comment.RENDERER_VERSION`.
+        '''
+        self.html = parse_comment(self.text)
+        self.html_version = RENDERER_VERSION
+
+    def get_html(self):
+        '''
+        Returns the stored HTML, or a fresh rendering if the stored HTML was
+        rendered by another version of the renderer.
+        '''
+        if self.html_version != RENDERER_VERSION:
+            return parse_comment(self.text)
+
+        return self.html
+
     def as_dict(self):
         me = {
                 'id': self.id,
-                'item': self.item.id,
-                'user_id': self.user.id,
+                'item': self.item_id,
+                'user_id': self.user_id,
                 'username': self.user.username,
                 'text': self.text,
-                'html': parse_comment(self.text),
+                'html': self.get_html(),
                 'reply_to': self.reply_to_id,
-                'created': self.created.isoformat()}
+                'created': self.created}
         return me
 
+
+class Notification(db.Model):
+    '''
+    An email waiting in the outbox, sent by the notification worker. See
+    :py:mod:`talkatv.notification`.
+    '''
+    __table_args__ = (
+            # The notifications that are due
+            db.Index('ix_notification_sent_send_after', 'sent', 'send_after'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime)
+    recipient = db.Column(db.String(255))
+    subject = db.Column(db.String())
+    body = db.Column(db.String())
+
+    #: The earliest time at which the worker tries to send the email
+    send_after = db.Column(db.DateTime)
+    sent = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String())
+
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'),
+            index=True)
+    comment = db.relationship('Comment',
+            backref=db.backref('notifications', lazy='dynamic'))
+
+    #: The notified user, if any
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    user = db.relationship('User',
+            backref=db.backref('notifications', lazy='dynamic'))
+
+    def __init__(self, recipient, subject, body, comment=None, user=None,
+            send_after=None):
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+
+        if comment:
+            self.comment = comment
+
+        if user:
+            self.user = user
+
+        self.created = datetime.utcnow()
+        self.send_after = send_after or self.created
+        self.attempts = 0
+
+    def __repr__(self):
+        return '<Notification {0} ({1})>'.format(
+                self.subject,
+                self.recipient)
+
 MODELS = [
         User,
         Comment,
         Item,
         OpenID,
-        Site]
+        Site,
+        Notification]
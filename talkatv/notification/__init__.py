@@ -15,11 +15,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import smtplib
+import socket
+import threading
 import time
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
+from itertools import izip
 
-from talkatv import app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload_all
+
+from talkatv import app, db
+from talkatv.models import Notification
 
 
 def get_smtp_connection():
@@ -50,15 +60,126 @@ def get_smtp_connection():
     return server
 
 
-SERVER = get_smtp_connection()
+class SMTPPool(object):
+    '''
+    A thread-safe pool of SMTP connections.
 
+    Connections are opened when needed, at most ``size`` at a time. Idle
+    connections are checked with ``NOOP`` before they are handed out again
+    and closed once they have been idle for ``idle_timeout`` seconds.
 
-def send_mail(from_addr, to_addrs, subject, body):
+    :param callable connect: Returns a new, logged in, SMTP connection
     '''
-    Send an email via the :py:data:`SERVER` SMTP connection.
+    def __init__(self, connect, size=4, idle_timeout=60):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Check out a connection for the duration of the ``with`` block.
+
+        The connection is returned to the pool, unless the block raised an
+        error that leaves the connection in an unknown state. Closing a
+        generator that holds the connection returns it as well.
+        '''
+        self._slots.acquire()
+
+        try:
+            server = self._checkout()
+
+            try:
+                yield server
+            except (smtplib.SMTPResponseException,
+                    smtplib.SMTPRecipientsRefused):
+                # The server refused the message, the connection is fine
+                self._checkin(server)
+                raise
+            except GeneratorExit:
+                # A generator holding the connection was closed between two
+                # messages, the connection is fine
+                self._checkin(server)
+                raise
+            except:
+                close_connection(server)
+                raise
+            else:
+                self._checkin(server)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        '''
+        Close all idle connections.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for last_used, server in idle:
+            close_connection(server)
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+
+                last_used, server = self._idle.pop()
+
+            if time.time() - last_used > self.idle_timeout:
+                close_connection(server)
+                continue
+
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+            close_connection(server)
+
+        return self.connect()
+
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append((time.time(), server))
+
+
+def close_connection(server):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, socket.error):
+        server.close()
+
+
+#: Pool of connections to the SMTP server, see :py:func:`get_smtp_connection`.
+#: Uses the app config:
+#:
+#: - ``SMTP_POOL_SIZE``: Maximum number of open connections
+#: - ``SMTP_IDLE_TIMEOUT``: Seconds before an idle connection is closed
+POOL = SMTPPool(
+        get_smtp_connection,
+        app.config['SMTP_POOL_SIZE'],
+        app.config['SMTP_IDLE_TIMEOUT'])
 
-    TODO:
-        This should probably be offloaded to celery or similar
+
+def make_message(from_addr, to_addrs, subject, body):
+    message = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+    message['From'] = from_addr
+    message['To'] = ', '.join(to_addrs)
+    message['Subject'] = subject.encode('utf-8')
+
+    return message
+
+
+def send_mail(from_addr, to_addrs, subject, body):
+    '''
+    Send an email via a connection from :py:data:`POOL`. Failures are raised,
+    it's up to the caller to retry.
 
     :param string from_addr: From: address
     :param list to_addrs: destination addresses
@@ -66,45 +187,214 @@ def send_mail(from_addr, to_addrs, subject, body):
     :param string body: message body
     :rtype: SMTP.sendmail() return data
     '''
-    global SERVER
+    result = send_many([(from_addr, to_addrs, subject, body)])[0]
+
+    if isinstance(result, Exception):
+        raise result
+
+    return result
+
+
+def send_many(messages):
+    '''
+    Send several emails in one SMTP session, using a single connection from
+    :py:data:`POOL`.
+
+    :param list messages: ``(from_addr, to_addrs, subject, body)`` tuples,
+        see :py:func:`send_mail`
+    :rtype: list with the SMTP.sendmail() return data, or the raised
+        exception, for each message
+    '''
+    return list(iter_send_many(messages))
 
-    message = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
-    message['From'] = from_addr
-    message['To'] = ', '.join(to_addrs)
-    message['Subject'] = subject.encode('utf-8')
+
+def iter_send_many(messages):
+    '''
+    Like :py:func:`send_many`, but yields the result of each message as soon
+    as it has been sent. The connection is held until the generator is
+    exhausted or closed.
+    '''
+    sent = 0
 
     try:
-        return SERVER.sendmail(from_addr, to_addrs, message.as_string())
-    except smtplib.SMTPException as exc:
-        app.logger.error('{0} - Failed to send mail: {1}'.format(
-            to_addrs,
-            exc))
+        with POOL.connection() as server:
+            for from_addr, to_addrs, subject, body in messages:
+                message = make_message(from_addr, to_addrs, subject, body)
 
-        app.logger.info('Trying to send mail again...')
-        SERVER = get_smtp_connection()
-        time.sleep(1)
-        return send_mail(from_addr, to_addrs, subject, body)
+                try:
+                    result = server.sendmail(
+                        from_addr,
+                        to_addrs,
+                        message.as_string())
+                except (smtplib.SMTPResponseException,
+                        smtplib.SMTPRecipientsRefused) as exc:
+                    result = exc
 
+                sent += 1
 
-def send_comment_notification(email, user, comment, item):
-    mail_result = send_mail(
-            app.config['NOTIFICATION_ADDR'],
-            [email],
-            '{0} commented on {1}'.format(
+                yield result
+    except (smtplib.SMTPException, socket.error) as exc:
+        # The connection failed, none of the remaining messages were sent
+        for i in range(len(messages) - sent):
+            yield exc
+
+
+def queue_comment_notification(recipient, user, comment, item):
+    '''
+    Add a notification about ``comment`` to the outbox. The notification is
+    added to the database session and committed along with the caller's
+    transaction.
+
+    The notification is held back for the notification window of the
+    recipient, to be sent in a digest with any other notifications to the
+    recipient, see :py:func:`process_outbox`.
+
+    :param User recipient: the notified user
+    :param User user: the author of the comment
+    '''
+    window = recipient.notification_window
+
+    if window is None:
+        window = app.config['NOTIFICATION_DIGEST_WINDOW']
+
+    notification = Notification(
+            recipient.email,
+            u'{0} commented on {1}'.format(
                 user.username,
                 item.title),
-            '{user} commented on {title}:\n\n\t{text}\
+            u'{user} commented on {title}:\n\n\t{text}\
             \n\nto see the comment, go to \n\n\t{url}'.format(
                 user=user.username,
                 title=item.title,
                 url=item.url,
-                text=comment.text))
+                text=comment.text),
+            comment,
+            recipient,
+            datetime.utcnow() + timedelta(seconds=window))
+
+    db.session.add(notification)
+
+    return notification
 
-    if mail_result is None:
-        app.logger.error('{0} couldn\'t send mail: {1}'.format(
-                email,
-                mail_result))
+
+def make_digest(notifications):
+    '''
+    Returns a ``(from_addr, to_addrs, subject, body)`` tuple for
+    :py:func:`send_many` with all ``notifications``, which have to share the
+    same recipient, in one message.
+    '''
+    if len(notifications) == 1:
+        subject = notifications[0].subject
+        body = notifications[0].body
     else:
-        app.logger.error('{0} comment nofication send result: {1}'.format(
-            email,
-            mail_result))
+        titles = set(notification.comment.item.title
+                if notification.comment else None
+                for notification in notifications)
+
+        if len(titles) == 1 and not None in titles:
+            subject = u'{0} new comments on {1}'.format(
+                    len(notifications),
+                    titles.pop())
+        else:
+            subject = u'{0} new comments'.format(len(notifications))
+
+        body = u'\n\n----\n\n'.join(
+                notification.body for notification in notifications)
+
+    return (
+            app.config['NOTIFICATION_ADDR'],
+            [notifications[0].recipient],
+            subject,
+            body)
+
+
+def process_outbox(limit=None, worker=0, workers=1):
+    '''
+    Send the notifications in the outbox that are due, in one SMTP session.
+
+    Once a notification is due, all pending notifications to the same
+    recipient are sent along with it as one digest, see
+    :py:func:`make_digest`.
+
+    A failed notification is retried after ``NOTIFICATION_RETRY_DELAY``
+    seconds, doubling the delay on every attempt, until it has been
+    attempted ``NOTIFICATION_MAX_ATTEMPTS`` times.
+
+    :param int limit: Maximum number of emails to send, defaults to
+        ``NOTIFICATION_BATCH_SIZE``
+    :param int worker: Number of this worker, when the outbox is processed by
+        ``workers`` workers at once. Each worker only sends the notifications
+        to its share of the users.
+    :rtype: number of sent emails
+    '''
+    now = datetime.utcnow()
+
+    pending = Notification.query.filter(Notification.sent == None)\
+            .filter(Notification.attempts <
+                    app.config['NOTIFICATION_MAX_ATTEMPTS'])
+
+    if workers > 1:
+        pending = pending.filter(
+                func.coalesce(Notification.user_id, 0) % workers == worker)
+
+    recipients = pending.filter(Notification.send_after <= now)\
+            .with_entities(Notification.recipient)\
+            .group_by(Notification.recipient)\
+            .order_by(func.min(Notification.send_after))\
+            .limit(limit or app.config['NOTIFICATION_BATCH_SIZE'])
+
+    digests = OrderedDict((recipient, []) for (recipient,) in recipients)
+
+    if not digests:
+        return 0
+
+    # The items of the comments are loaded along, for the digest subjects
+    for notification in pending.filter(
+            Notification.recipient.in_(digests.keys()))\
+                    .options(joinedload_all('comment.item'))\
+                    .order_by(Notification.created):
+        digests[notification.recipient].append(notification)
+
+    results = iter_send_many([make_digest(notifications)
+        for notifications in digests.values()])
+
+    digest_ids = [(recipient, [notification.id
+        for notification in notifications])
+        for recipient, notifications in digests.items()]
+
+    # The results come first, so that the sending generator runs to its end
+    # and returns the connection to the pool
+    for result, (recipient, ids) in izip(results, digest_ids):
+        # The commit of the previous digest has expired the notifications,
+        # they are loaded again in one query
+        notifications = Notification.query\
+                .filter(Notification.id.in_(ids))\
+                .all()
+
+        if isinstance(result, Exception):
+            app.logger.error('{0} - Failed to send mail: {1}'.format(
+                recipient,
+                result))
+        else:
+            app.logger.debug('{0} - Sent {1} notifications'.format(
+                recipient,
+                len(notifications)))
+
+        for notification in notifications:
+            notification.attempts += 1
+
+            if isinstance(result, Exception):
+                delay = app.config['NOTIFICATION_RETRY_DELAY'] * 2 ** (
+                        notification.attempts - 1)
+
+                notification.last_error = unicode(result)
+                notification.send_after = datetime.utcnow() + timedelta(
+                        seconds=delay)
+            else:
+                notification.sent = datetime.utcnow()
+
+        # Commit each digest as soon as it has been sent, so that it isn't
+        # sent again if a later one fails
+        db.session.commit()
+
+    return len(digests)
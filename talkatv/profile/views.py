@@ -20,6 +20,7 @@ from talkatv import app, db
 from talkatv.decorators import require_active_login
 from talkatv.forms import ProfileForm, ChangePasswordForm
 from talkatv.models import OpenID, User
+from talkatv.tools.auth import set_active_user, get_active_user
 
 
 @app.route('/profile/edit', methods=['GET', 'POST'])
@@ -37,7 +38,7 @@ def edit_profile():
         openid = OpenID.query.filter_by(url=form.openid.data).first()
 
         if not openid and form.openid.data:
-            openid = OpenID(g.user, form.openid.data)
+            openid = OpenID(get_active_user(), form.openid.data)
 
         if form.username.data and not form.username.data == g.user.username:
             g.user.username = form.username.data
@@ -49,7 +50,13 @@ def edit_profile():
             g.user.email = form.email.data
             flash('Your email has been changed to {0}'.format(form.email.data), 'info')
 
+        g.user.notification_window = form.notification_window.data
+
         db.session.commit()
+
+        # Update the username in the session
+        set_active_user(get_active_user())
+
         return redirect(url_for('edit_profile'))
 
     else:
@@ -58,6 +65,8 @@ def edit_profile():
         form.email.data = request.args.get('email',
                 getattr(g.user, 'email', form.email.data))
 
+        form.notification_window.data = g.user.notification_window
+
         if not g.user.openids.count():
             form.openid.data = request.args.get('openid', form.openid.data)
         else:
@@ -22,7 +22,7 @@ from xml.etree import ElementTree
 from StringIO import StringIO
 
 from talkatv import app
-from talkatv.tools.cors import jsonify, allow_all_origins
+from talkatv.tools.cors import jsonify, allow_configured_origins
 
 
 @app.route('/salmon/replies', methods=['POST'])
@@ -54,4 +54,4 @@ def salmon_all():
             'title': root_em.find(ATOM_NS + 'title').text,
             'updated': root_em.find(ATOM_NS + 'updated').text}
 
-    return jsonify(_allow_origin_cb=allow_all_origins, **comment)
+    return jsonify(_allow_origin_cb=allow_configured_origins, **comment)
@@ -21,6 +21,11 @@ from flask.ext.wtf import Form, html5, TextField, validators
 
 class SiteForm(Form):
     domain = TextField('Domain', [validators.Required()])
+    ignored_params = TextField('Ignored query parameters',
+            [validators.Optional()],
+            description=u'Query parameters that don\'t change the page, '
+            'separated by spaces, e.g. "ref sort". Use * to ignore the whole '
+            'query string.')
 
     def __init__(self, *args, **kw):
         Form.__init__(self, *args, **kw)
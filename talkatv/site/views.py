@@ -18,7 +18,10 @@ from flask import g, render_template, flash
 
 from talkatv.decorators import require_active_login
 from talkatv.site.forms import SiteForm
-from talkatv.models import Site, Item
+from talkatv.models import Item, Site
+from talkatv.item import assign_items_to_site
+from talkatv.api import forget_threads
+from talkatv.tools.auth import get_active_user
 from talkatv import app, db
 
 
@@ -28,26 +31,27 @@ def add_site():
     form = SiteForm()
 
     if form.validate_on_submit():
-        site = Site(g.user, form.domain.data)
+        site = Site(get_active_user(), form.domain.data,
+                form.ignored_params.data or None)
 
-        items = Item.query.filter(Item.url.ilike('%{0}%'.format(
-            form.domain.data)))
-
-        for item in items.all():
-            item.site = site
-            db.session.commit()
+        db.session.add(site)
+        db.session.flush()
 
-        flash('''Site added, {0} items registered
-        as belonging to the domain'''.format(items.count()))
+        item_count = assign_items_to_site(site)
 
-        db.session.add(site)
         db.session.commit()
 
+        forget_threads(item_id for (item_id,)
+                in site.items.with_entities(Item.id))
+
+        flash('''Site added, {0} items registered
+        as belonging to the domain'''.format(item_count))
+
     return render_template('talkatv/site/add.html', form=form)
 
 @app.route('/site/list')
 @require_active_login()
 def list_sites():
-    sites = Site.query.filter(Site.owner==g.user).all()
+    sites = Site.query.filter(Site.owner_id == g.user.id).all()
 
     return render_template('talkatv/site/list.html', sites=sites)
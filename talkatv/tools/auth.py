@@ -14,7 +14,53 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import g, session
+from flask import g, session, abort
+from werkzeug.local import LocalProxy
+
+from talkatv.models import User
+
+
+class SessionUser(LocalProxy):
+    '''
+    Proxy for the active user, built from the signed session cookie.
+
+    The ``id`` and ``username`` are read from the session, the `User` is only
+    loaded from the database when any other attribute is used. Pass
+    :py:func:`get_active_user` to code that needs the actual `User`, e.g.
+    when assigning it to a relationship.
+    '''
+    def __init__(self, user_id, username):
+        LocalProxy.__init__(self, self._load)
+        object.__setattr__(self, '_user_id', user_id)
+        object.__setattr__(self, '_username', username)
+        object.__setattr__(self, '_user', None)
+
+    def __nonzero__(self):
+        return True
+
+    @property
+    def id(self):
+        return self._user_id
+
+    @property
+    def username(self):
+        if self._user is not None:
+            return self._user.username
+
+        return self._username
+
+    def _load(self):
+        if self._user is None:
+            user = User.query.get(self._user_id)
+
+            if user is None:
+                # The user has been removed
+                clear_active_user()
+                abort(403)
+
+            object.__setattr__(self, '_user', user)
+
+        return self._user
 
 
 def set_active_user(user):
@@ -23,4 +69,24 @@ def set_active_user(user):
     '''
     g.user = user
     session['user_id'] = user.id
+    session['username'] = user.username
     return True
+
+
+def clear_active_user():
+    '''
+    Log out the active user
+    '''
+    g.user = None
+    session.pop('user_id', None)
+    session.pop('username', None)
+
+
+def get_active_user():
+    '''
+    Returns the `User` object of the active user, or None.
+    '''
+    if isinstance(g.user, SessionUser):
+        return g.user._get_current_object()
+
+    return g.user
@@ -0,0 +1,74 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from flask import request, current_app
+
+from talkatv.tools.compress import precompress, get_precompressed
+
+
+class Bundle(object):
+    '''
+    A JavaScript bundle, built once and kept in memory in each of the
+    supported content codings, see
+    :py:func:`talkatv.tools.compress.precompress`.
+
+    The bundle is identified by the hash of its content, which is used in
+    its fingerprinted URL and in the ETag of each of its codings.
+
+    :param list parts: The sources of the bundle
+    '''
+    separator = '\n/* -- DIVIDER -- */\n'
+
+    def __init__(self, parts):
+        data = self.separator.join(parts)
+
+        self.hash = hashlib.sha1(data).hexdigest()[:16]
+        self.variants = precompress(data)
+
+    def make_response(self, max_age):
+        '''
+        Returns a response with the bundle, compressed as negotiated with the
+        client, or a ``304 Not Modified`` response if the client has it.
+
+        :param int max_age: Seconds the client may cache the bundle for
+        '''
+        encoding, data = get_precompressed(self.variants)
+
+        response = current_app.response_class(data,
+                mimetype='application/javascript')
+
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+        response.vary.add('Accept-Encoding')
+        response.set_etag(self.get_etag(encoding))
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+
+        return response.make_conditional(request)
+
+    def get_etag(self, encoding=None):
+        '''
+        Returns the ETag of the bundle in the content coding ``encoding``.
+        Each coding is a different representation, so each gets its own
+        strong ETag.
+        '''
+        if encoding is None:
+            return self.hash
+
+        return '{0}-{1}'.format(self.hash, encoding)
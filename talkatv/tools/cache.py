@@ -0,0 +1,107 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from collections import OrderedDict
+from time import time
+
+from werkzeug.contrib.cache import BaseCache, FileSystemCache, NullCache
+
+
+class LRUCache(BaseCache):
+    '''
+    In-process cache that evicts the least recently used entry once it holds
+    more than ``threshold`` entries. Entries also expire after their timeout.
+
+    The cache is local to the process, each process of a multi-process
+    deployment has its own copy and invalidations are not shared between
+    them. Use :py:class:`werkzeug.contrib.cache.FileSystemCache` in that case.
+    '''
+    def __init__(self, threshold=500, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._cache = OrderedDict()
+        self._threshold = threshold
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._cache.pop(key)
+            except KeyError:
+                return None
+
+            if expires and expires <= time():
+                return None
+
+            # Re-insert the entry to mark it as the most recently used
+            self._cache[key] = (expires, value)
+
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        expires = time() + timeout if timeout else 0
+
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (expires, value)
+
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def make_cache(config, prefix):
+    '''
+    Create a cache from the app config.
+
+    Uses the config keys starting with ``prefix``, e.g. for
+    ``prefix='RESPONSE_CACHE'``:
+
+    - ``RESPONSE_CACHE``: ``'memory'``, ``'filesystem'`` or ``None`` to
+      disable the cache.
+    - ``RESPONSE_CACHE_DIR``: Directory used by the ``filesystem`` backend.
+    - ``RESPONSE_CACHE_THRESHOLD``: Maximum number of cached entries.
+    - ``RESPONSE_CACHE_TIMEOUT``: Seconds before an entry expires.
+    '''
+    backend = config.get(prefix)
+    threshold = config.get(prefix + '_THRESHOLD', 500)
+    timeout = config.get(prefix + '_TIMEOUT', 300)
+
+    if backend == 'memory':
+        return LRUCache(threshold=threshold, default_timeout=timeout)
+    elif backend == 'filesystem':
+        return FileSystemCache(config[prefix + '_DIR'],
+                threshold=threshold,
+                default_timeout=timeout)
+    elif backend is None:
+        return NullCache()
+
+    raise ValueError('Unknown {0} backend: {1}'.format(prefix, backend))
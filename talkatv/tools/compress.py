@@ -0,0 +1,207 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+
+from cStringIO import StringIO
+from gzip import GzipFile
+
+from flask import request
+from werkzeug.http import quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(data, level):
+    buf = StringIO()
+
+    with GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) \
+            as gzip_file:
+        gzip_file.write(data)
+
+    return buf.getvalue()
+
+
+def deflate_compress(data, level):
+    return zlib.compress(data, level)
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+#: Supported content codings, in order of preference
+ENCODINGS = [
+        ('gzip', gzip_compress),
+        ('deflate', deflate_compress)]
+
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', brotli_compress))
+
+COMPRESSORS = dict(ENCODINGS)
+
+#: Content codings that streamed responses can be compressed with, see
+#: :py:func:`iter_compressed`
+STREAM_ENCODINGS = ['gzip', 'deflate']
+
+
+def get_encoding(encodings=None):
+    '''
+    Returns the content coding of the response to the current request, as
+    negotiated from its Accept-Encoding header, or None.
+
+    :param list encodings: The codings to choose from, defaults to all
+        supported ones
+    '''
+    if encodings is None:
+        encodings = [encoding for encoding, compress_func in ENCODINGS]
+
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(data, encoding, level=6):
+    return COMPRESSORS[encoding](data, level)
+
+
+def iter_compressed(chunks, encoding, level=6):
+    '''
+    Compress the ``chunks`` of a streamed response with one of the
+    :py:data:`STREAM_ENCODINGS`. The compressed data is flushed after every
+    chunk, so that the client gets each part of the response as it's
+    produced.
+    '''
+    if encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def precompress(data, level=9):
+    '''
+    Returns a dict of ``data`` in each of the supported content codings, and
+    uncompressed under the None key, for :py:func:`get_precompressed`.
+    '''
+    variants = {None: data}
+
+    for encoding, compress_func in ENCODINGS:
+        variants[encoding] = compress_func(data, level)
+
+    return variants
+
+
+def get_precompressed(variants):
+    '''
+    Returns the content coding and data of the best variant of
+    :py:func:`precompress` for the current request.
+
+    The response has to carry the coding in its Content-Encoding header and
+    ``Accept-Encoding`` in its Vary header.
+    '''
+    encoding = get_encoding()
+
+    return encoding, variants[encoding]
+
+
+class ResponseCompressor(object):
+    '''
+    Compresses the responses of an app with gzip, deflate or, if the brotli
+    module is installed, brotli, as negotiated with the client.
+
+    Uses the app config:
+
+    - ``COMPRESS_MIMETYPES``: The types of responses to compress
+    - ``COMPRESS_MIN_SIZE``: Smaller responses are sent uncompressed
+    - ``COMPRESS_LEVEL``: Compression level, 1-9
+
+    Streamed responses are compressed as they are sent, see
+    :py:func:`iter_compressed`. File responses and responses that already
+    have a Content-Encoding are left alone.
+
+    The ETag of a compressed response is made weak, since the compressed and
+    the uncompressed response are not the same bytes. Conditional requests
+    have to be checked with a weak comparison.
+    '''
+    def __init__(self, app):
+        self.mimetypes = frozenset(app.config['COMPRESS_MIMETYPES'])
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+
+        app.after_request(self.compress_response)
+
+    def compress_response(self, response):
+        if response.status_code != 200 or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers or \
+                not response.mimetype in self.mimetypes:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if response.is_streamed:
+            encoding = get_encoding(STREAM_ENCODINGS)
+
+            if encoding is not None:
+                response.response = iter_compressed(
+                        response.response,
+                        encoding,
+                        self.level)
+                response.headers['Content-Encoding'] = encoding
+                weaken_etag(response)
+
+            return response
+
+        data = response.data
+
+        if len(data) < self.min_size:
+            return response
+
+        encoding = get_encoding()
+
+        if encoding is None:
+            return response
+
+        response.data = compress(data, encoding, self.level)
+        response.headers['Content-Encoding'] = encoding
+        weaken_etag(response)
+
+        return response
+
+
+def weaken_etag(response):
+    etag, weak = response.get_etag()
+
+    if etag and not weak:
+        set_weak_etag(response, etag)
+
+
+def set_weak_etag(response, etag):
+    # Werkzeug marks weak ETags with a lowercase w/, which HTTP doesn't allow
+    response.headers['ETag'] = 'W/' + quote_etag(etag)
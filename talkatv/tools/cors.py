@@ -14,16 +14,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import fnmatch
+import re
+
+from itertools import chain
 from urlparse import urlparse, urlunparse
 
 import flask
 
 from flask import request
 from talkatv import app
+from talkatv.tools.compress import set_weak_etag
+from talkatv.tools.encoding import get_encoder
+
+#: Encodes the API responses, see :py:func:`talkatv.tools.encoding.get_encoder`
+ENCODER = get_encoder(app.config['JSON_ENCODER'])
 
 
-def jsonify(_allow_origin_cb=None, **kw):
-    response = flask.jsonify(**kw)
+def jsonify(_allow_origin_cb=None, _etag=None, _last_modified=None, **kw):
+    response = app.response_class(
+            ENCODER(kw, indent=None if request.is_xhr else 2),
+            mimetype='application/json')
 
     callback = request.args.get('callback')
 
@@ -31,26 +42,111 @@ def jsonify(_allow_origin_cb=None, **kw):
         response.response.insert(0, '{0}('.format(callback))
         response.response.append(');')
 
-    if _allow_origin_cb and 'Origin' in request.headers:
-        origin = _allow_origin_cb(request.headers['Origin'])
-        if origin:
-            response.headers['Access-Control-Allow-Origin'] = origin
-    else:
-        response.headers['Access-Control-Allow-Origin'] = \
-                app.config['CORS_ALLOW_ORIGIN']
-
-    response.headers['Access-Control-Allow-Credentials'] = \
-            app.config['CORS_ALLOW_CREDENTIALS']
-    response.headers['Access-Control-Max-Age'] = \
-            app.config['CORS_MAX_AGE']
-    response.headers['Access-Control-Allow-Headers'] = \
-            app.config['CORS_ALLOW_HEADERS']
-    response.headers['Access-Control-Allow-Methods'] = \
-            app.config['CORS_ALLOW_METHODS']
+    set_validators(response, _etag, _last_modified)
+    set_cors_headers(response, _allow_origin_cb)
+
+    return response
+
+
+def stream_jsonify(chunks, _allow_origin_cb=None, _etag=None,
+        _last_modified=None):
+    '''
+    Like :py:func:`jsonify`, but the response body is streamed from
+    ``chunks``, an iterable of JSON parts. The parts are sent in blocks of
+    about ``STREAM_BUFFER_SIZE`` bytes.
+
+    The request context is kept until the response has been sent, so the
+    iterable may query the database.
+    '''
+    chunks = buffer_chunks(chunks, app.config['STREAM_BUFFER_SIZE'])
+
+    callback = request.args.get('callback')
+
+    if callback:
+        chunks = chain(['{0}('.format(callback)], chunks, [');'])
+
+    response = app.response_class(
+            flask.stream_with_context(chunks),
+            mimetype='application/json')
+
+    set_validators(response, _etag, _last_modified)
+    set_cors_headers(response, _allow_origin_cb)
 
     return response
 
 
+def buffer_chunks(chunks, size):
+    '''
+    Join the parts from ``chunks`` into blocks of at least ``size`` bytes,
+    except for the last one.
+    '''
+    buffered = []
+    buffered_size = 0
+
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+
+        if buffered_size >= size:
+            yield ''.join(buffered)
+
+            buffered = []
+            buffered_size = 0
+
+    if buffered:
+        yield ''.join(buffered)
+
+
+def not_modified(_allow_origin_cb=None, _etag=None, _last_modified=None):
+    '''
+    Returns an empty ``304 Not Modified`` response, with the same validator
+    and CORS headers as :py:func:`jsonify` would have set. The ETag is weak
+    if the client sent it as a weak one, i.e. it has a compressed response.
+    '''
+    response = app.response_class(status=304)
+
+    set_validators(response, _etag, _last_modified)
+
+    if _etag and request.if_none_match.is_weak(_etag):
+        set_weak_etag(response, _etag)
+    set_cors_headers(response, _allow_origin_cb)
+
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    '''
+    Set the ETag and Last-Modified headers of a response. Clients have to
+    revalidate the response before they use a cached copy of it.
+    '''
+    if etag:
+        response.set_etag(etag)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    if etag or last_modified:
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+
+
+def set_cors_headers(response, _allow_origin_cb=None):
+    '''
+    Add the CORS headers for the requesting origin to ``response``, see
+    :py:meth:`CORSPolicy.get_headers`.
+
+    With an ``_allow_origin_cb`` the ``Access-Control-Allow-Origin`` header
+    depends on the ``Origin`` of the request, so shared caches are told to
+    keep a copy of the response per origin.
+    '''
+    response.headers.extend(POLICY.get_headers(
+        request.headers.get('Origin'),
+        _allow_origin_cb))
+
+    if _allow_origin_cb is not None:
+        response.vary.add('Origin')
+
+
 def allow_all_origins(origin):
     '''
     This can be used to allow all origins, since * is prohibited if you use
@@ -59,5 +155,147 @@ def allow_all_origins(origin):
     Example:
         desqus.tools.cors.jsonify(_allow_origin_cb=allow_all_origins, **data)
     '''
-    app.logger.debug('Allowing origin {0}'.format(origin))
     return origin
+
+
+def allow_configured_origins(origin):
+    '''
+    Allows the origins in ``CORS_ALLOWED_ORIGINS``, or all origins if it is
+    None, see :py:class:`CORSPolicy`.
+    '''
+    if POLICY.is_allowed(origin):
+        return origin
+
+
+class CORSPolicy(object):
+    '''
+    The CORS headers of the API responses, compiled from the config once.
+
+    ``CORS_ALLOWED_ORIGINS`` is either None, to allow all origins, or a list
+    of origins, e.g. ``https://example.org``. Shell-style wildcards are
+    allowed, e.g. ``https://*.example.org``.
+
+    The headers for each origin are cached, adding them to a response is a
+    single ``extend``.
+
+    :param dict config: the app config
+    :param int max_age: the ``Access-Control-Max-Age`` value
+    '''
+    #: Maximum number of origins to cache the headers for
+    cache_size = 1000
+
+    def __init__(self, config, max_age):
+        self.headers = (
+                ('Access-Control-Allow-Credentials',
+                    config['CORS_ALLOW_CREDENTIALS']),
+                ('Access-Control-Max-Age', str(max_age)),
+                ('Access-Control-Allow-Headers',
+                    config['CORS_ALLOW_HEADERS']),
+                ('Access-Control-Allow-Methods',
+                    config['CORS_ALLOW_METHODS']))
+
+        self.default_headers = (
+                ('Access-Control-Allow-Origin', config['CORS_ALLOW_ORIGIN']),
+                ) + self.headers
+
+        allowed_origins = config['CORS_ALLOWED_ORIGINS']
+
+        if allowed_origins is None:
+            self.allowed_origins = None
+            self.origin_pattern = None
+        else:
+            self.allowed_origins = frozenset(origin
+                    for origin in allowed_origins
+                    if not re.search(r'[*?[]', origin))
+
+            patterns = [fnmatch.translate(origin)
+                    for origin in allowed_origins
+                    if not origin in self.allowed_origins]
+
+            self.origin_pattern = re.compile('|'.join(patterns)) \
+                    if patterns else None
+
+        self._cache = {}
+
+    def is_allowed(self, origin):
+        if self.allowed_origins is None:
+            return True
+
+        if origin in self.allowed_origins:
+            return True
+
+        return self.origin_pattern is not None and \
+                self.origin_pattern.match(origin) is not None
+
+    def get_headers(self, origin, allow_origin_cb=None):
+        '''
+        Returns the CORS headers for a response to a request from
+        ``origin``.
+
+        :param callable allow_origin_cb: Returns the
+            ``Access-Control-Allow-Origin`` value for an origin, or None to
+            deny it. Without a callback or an origin, ``CORS_ALLOW_ORIGIN`` is
+            sent.
+        '''
+        if not origin or allow_origin_cb is None:
+            return self.default_headers
+
+        key = (allow_origin_cb, origin)
+        headers = self._cache.get(key)
+
+        if headers is None:
+            allow_origin = allow_origin_cb(origin)
+
+            if allow_origin:
+                headers = (
+                        ('Access-Control-Allow-Origin', allow_origin),
+                        ) + self.headers
+            else:
+                headers = self.headers
+
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+
+            self._cache[key] = headers
+
+        return headers
+
+
+#: The CORS policy of the API responses
+POLICY = CORSPolicy(app.config, app.config['CORS_MAX_AGE'])
+
+
+class PreflightMiddleware(object):
+    '''
+    WSGI middleware that answers CORS preflight requests, i.e. ``OPTIONS``
+    requests for paths below ``prefix``, without passing them on to the
+    application. No session is opened and the database isn't queried.
+
+    Like the API views, see :py:func:`allow_configured_origins`, the
+    requesting origin is allowed if it's in ``CORS_ALLOWED_ORIGINS``.
+    Browsers may cache the answer for ``CORS_PREFLIGHT_MAX_AGE`` seconds.
+
+    :param dict config: the app config, read once
+    '''
+    def __init__(self, wsgi_app, config, prefix='/api/'):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+
+        self.policy = CORSPolicy(config, config['CORS_PREFLIGHT_MAX_AGE'])
+        self.headers = [
+                ('Vary', 'Origin'),
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', '0')]
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'OPTIONS' or \
+                not environ.get('PATH_INFO', '').startswith(self.prefix):
+            return self.wsgi_app(environ, start_response)
+
+        headers = self.policy.get_headers(
+                environ.get('HTTP_ORIGIN'),
+                allow_configured_origins)
+
+        start_response('200 OK', list(headers) + self.headers)
+
+        return []
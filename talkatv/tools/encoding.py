@@ -0,0 +1,98 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from datetime import date
+
+
+def encode_default(obj):
+    '''
+    Encode the types that JSON libraries don't support natively.
+    '''
+    if isinstance(obj, date):
+        return obj.isoformat()
+
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+def make_ujson_encoder():
+    import ujson
+
+    def encode(obj, indent=None):
+        return ujson.dumps(obj,
+                default=encode_default,
+                indent=indent or 0,
+                escape_forward_slashes=False)
+
+    # Older versions of ujson don't support default, or encode datetimes as
+    # timestamps
+    try:
+        if encode(date(2012, 9, 9)) == '"2012-09-09"':
+            return encode
+    except TypeError:
+        pass
+
+    raise ImportError('ujson does not support the default argument')
+
+
+def make_simplejson_encoder():
+    import simplejson
+
+    def encode(obj, indent=None):
+        return simplejson.dumps(obj, default=encode_default, indent=indent)
+
+    return encode
+
+
+def make_json_encoder():
+    import json
+
+    def encode(obj, indent=None):
+        return json.dumps(obj, default=encode_default, indent=indent)
+
+    return encode
+
+
+#: Encoder factories by name, fastest first. A factory raises ImportError if
+#: its library isn't installed.
+ENCODERS = OrderedDict([
+        ('ujson', make_ujson_encoder),
+        ('simplejson', make_simplejson_encoder),
+        ('json', make_json_encoder)])
+
+
+def get_encoder(name=None):
+    '''
+    Returns an encoder, a function ``encode(obj, indent=None)`` that returns
+    the JSON of ``obj`` as a string. Dates and datetimes are encoded as
+    ISO 8601 strings.
+
+    :param str name: One of the :py:data:`ENCODERS`, or None to use the
+        fastest JSON library that is installed
+    '''
+    if name is None:
+        for make_encoder in ENCODERS.values():
+            try:
+                return make_encoder()
+            except ImportError:
+                pass
+    elif name in ENCODERS:
+        try:
+            return ENCODERS[name]()
+        except ImportError:
+            pass
+
+    raise ValueError('JSON encoder not available: {0}'.format(name))
@@ -0,0 +1,43 @@
+# talkatv - Commenting backend for static pages
+# Copyright (C) 2012  talkatv contributors, see AUTHORS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from sqlalchemy import and_
+
+from talkatv import db
+
+
+def match_prefix(column, prefix):
+    '''
+    Returns a filter for the values of ``column`` that start with
+    ``prefix``, which is a range scan of an index on ``column``.
+
+    SQLite compares strings by their bytes, the values are selected by
+    their range. SQLite doesn't use an index for ``LIKE`` and ``GLOB``
+    patterns that are bound as parameters.
+
+    Other databases compare strings by the collation of the column, so
+    ``LIKE`` is used, with the wildcards in ``prefix`` escaped. On
+    PostgreSQL the index needs the ``varchar_pattern_ops`` operator class to
+    be used for ``LIKE``.
+    '''
+    if db.engine.dialect.name == 'sqlite':
+        return and_(
+                column >= prefix,
+                column < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+
+    return column.like(re.sub(r'([!%_])', r'!\1', prefix) + '%', escape='!')
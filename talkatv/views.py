@@ -19,17 +19,29 @@ import os
 from talkatv import app, oid, db
 
 from flask import render_template, flash, session, url_for, redirect, \
-        request, g
+        request, g, abort
 
 from talkatv.forms import LoginForm, RegistrationForm
 from talkatv.models import User, Item, OpenID
-from talkatv.tools.auth import set_active_user
+from talkatv.tools.auth import SessionUser, set_active_user, \
+        clear_active_user
+from talkatv.tools.bundle import Bundle
 
 
 @app.before_request
 def lookup_current_user():
+    '''
+    Set ``g.user`` from the session. The user is not loaded from the
+    database unless a view needs more than the id and username, see
+    :py:class:`talkatv.tools.auth.SessionUser`.
+    '''
     g.user = None
     if 'user_id' in session:
+        if 'username' in session:
+            g.user = SessionUser(session['user_id'], session['username'])
+            return
+
+        # The session predates the username being stored in it
         user = User.query.filter_by(id=session['user_id']).first()
 
         if user is None:
@@ -43,24 +55,67 @@ def index():
     return render_template('talkatv/index.html')
 
 
+#: The bundle of jQuery, Raven and the talkatv client, built at startup if
+#: talkatv serves it
+JS_BUNDLE = None
+
 if 'SENTRY_PUBLIC_DSN' in app.config:
-    from flask import Response
+    EXTLIB_DIR = os.path.join(app.root_path, os.pardir, 'extlib')
+
+    def read_extlib(path):
+        with open(os.path.join(EXTLIB_DIR, path)) as source:
+            return source.read()
+
+    JS_BUNDLE = Bundle([
+        #read_extlib('zepto/zepto.js'),
+        read_extlib('jquery/jquery-1.8.1.js'),
+        read_extlib('raven/raven-0.5.2.js'),
+        'Raven.config(\'{0}\');'.format(app.config['SENTRY_PUBLIC_DSN']),
+        read_extlib('talkatv-client/talkatv.js')])
 
     @app.route('/talkatv.js')
     @app.route('/static/js/talkatv.js')
     def include_raven_js():
-        # TODO this is an ugly solution.
-        #zepto = open('extlib/zepto/zepto.js').read()
-        jquery = open('extlib/jquery/jquery-1.8.1.js').read()
-        raven = open('extlib/raven/raven-0.5.2.js').read()
-        raven_config = 'Raven.config(\'{0}\');'.format(
-                app.config['SENTRY_PUBLIC_DSN'])
-        talkatv = open('extlib/talkatv-client/talkatv.js').read()
-
-        response = Response('\n/* -- DIVIDER -- */\n'.join([
-            jquery, raven, raven_config, talkatv]))
-        response.mimetype = 'application/javascript'
-        return response
+        return JS_BUNDLE.make_response(app.config['JS_BUNDLE_MAX_AGE'])
+
+    @app.route('/static/js/talkatv.<fingerprint>.js')
+    def fingerprinted_js(fingerprint):
+        '''
+        The bundle under a URL that changes with its content, so that it can
+        be cached forever.
+        '''
+        if fingerprint != JS_BUNDLE.hash:
+            return abort(404)
+
+        return JS_BUNDLE.make_response(60 * 60 * 24 * 365)
+
+
+#: Loads the talkatv client, see :py:func:`js_loader`
+JS_LOADER_SOURCE = '''(function () {{
+    var script = document.createElement('script');
+    script.src = (window.talkatv_home || window.desqus_home) + '{path}';
+    script.type = 'text/javascript';
+    document.body.appendChild(script);
+}})();
+'''
+
+if JS_BUNDLE is not None:
+    JS_LOADER = Bundle([JS_LOADER_SOURCE.format(
+        path='/static/js/talkatv.{0}.js'.format(JS_BUNDLE.hash))])
+else:
+    JS_LOADER = Bundle([JS_LOADER_SOURCE.format(
+        path='/static/js/talkatv.js')])
+
+
+@app.route('/talkatv-loader.js')
+def js_loader():
+    '''
+    A small script that loads the talkatv client, for the pages that embed
+    the comments. Clients cache it for ``JS_BUNDLE_MAX_AGE`` seconds only.
+    If talkatv serves the bundle, the loader loads it from its fingerprinted
+    URL, which clients cache for a year, see :py:func:`fingerprinted_js`.
+    '''
+    return JS_LOADER.make_response(app.config['JS_BUNDLE_MAX_AGE'])
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -73,7 +128,7 @@ def login():
 
     if form.validate_on_submit():
         flash(u'Logged in as {0}'.format(form.user.username), 'info')
-        session['user_id'] = form.user.id
+        set_active_user(form.user)
         return form.redirect('index')
     elif form.openid.data:
         return oid.try_login(form.openid.data, ask_for=['email', 'nickname'])
@@ -144,18 +199,33 @@ def register():
     return render_template('talkatv/register.html', form=form)
 
 
+ITEM_LIST_ORDER = {
+        'created': (Item.created.desc(),),
+        # Items without comments last, regardless of how the database sorts
+        # NULL values
+        'activity': (Item.last_comment_at == None,
+            Item.last_comment_at.desc()),
+        'comments': (Item.comment_count.desc(), Item.created.desc())}
+
+
 @app.route('/item/list')
 @app.route('/item/list/page/<int:page>')
 def item_list(page=1):
-    page = Item.query.order_by(Item.created.desc()).paginate(
+    sort = request.args.get('sort', 'created')
+
+    if not sort in ITEM_LIST_ORDER:
+        sort = 'created'
+
+    page = Item.query.order_by(*ITEM_LIST_ORDER[sort]).paginate(
             page,
             app.config.get('ITEMS_PER_PAGE', 20))
 
-    return render_template('talkatv/item-list.html', items_page=page)
+    return render_template('talkatv/item-list.html', items_page=page,
+            sort=sort)
 
 
 @app.route('/logout')
 def logout():
-    del session['user_id']
+    clear_active_user()
     flash(u'You have been logged out.')
     return redirect(url_for('index'))